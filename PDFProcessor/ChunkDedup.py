@@ -0,0 +1,104 @@
+import re
+import zlib
+import random
+import hashlib
+from collections import OrderedDict
+
+NUM_PERM = 64
+BANDS = 16   # LSH bands of NUM_PERM // BANDS rows
+PRIME = (1 << 61) - 1
+# batches remembered by the index, the least recently seen are forgotten
+MAX_ENTRIES = 100000
+PERMUTATIONS = [(random.Random(seed).randrange(1, PRIME), random.Random(-seed).randrange(0, PRIME)) for seed in range(1, NUM_PERM + 1)]
+
+
+def normalize(batch: str) -> str:
+  return re.sub(r"\s+", " ", batch).strip().lower()
+
+
+def minhash(text: str) -> tuple:
+  """
+  MinHash signature of the 3-word shingles of a normalized text
+  """
+  words = text.split(" ")
+  shingles = {" ".join(words[idx:idx + 3]) for idx in range(max(1, len(words) - 2))}
+  hashes = [zlib.crc32(shingle.encode()) for shingle in shingles]
+  return tuple(min((a * value + b) % PRIME for value in hashes) for a, b in PERMUTATIONS)
+
+
+class ChunkDedup:
+  """
+  Run-wide index of the batches already sent to the LLM (headers, footers, disclaimers repeat on every page
+  and across documents). Every unique batch is inferred once and its response is fanned out to the duplicates.
+  Duplicates are matched after normalization (case, whitespace). With similarity < 1 near-duplicates
+  (MinHash with LSH banding on 3-word shingles, estimated Jaccard >= similarity) are counted in the stats,
+  but they are inferred on their own text: a signature block differs from the previous one exactly in the name.
+  Only the hash of a batch is kept with its response (and signature), for the max_entries most recently seen batches
+  """
+  def __init__(self, similarity: float = 1.0, max_entries: int = MAX_ENTRIES):
+    self.similarity = similarity
+    self.max_entries = max_entries
+    self.responses = OrderedDict()    # hash of normalized text -> response, least recently seen first
+    self.signatures = OrderedDict()   # hash of normalized text -> (MinHash signature, bands) (near-duplicates only)
+    self.buckets = {}                 # (band, band hash) -> hashes of normalized text
+    self.batches = 0
+    self.avoided = 0
+    self.unique = 0
+    self.near = 0
+
+  def index(self, key: bytes, normalized: str) -> None:
+    """
+    adds the signature of a new batch to the LSH buckets, counting it if it is a near-duplicate
+    """
+    signature = minhash(normalized)
+    rows = NUM_PERM // BANDS
+    bands = [(band, hash(signature[band * rows:(band + 1) * rows])) for band in range(BANDS)]
+    candidates = {candidate for band in bands for candidate in self.buckets.get(band, ())}
+    if any(sum(a == b for a, b in zip(signature, self.signatures[candidate][0])) / NUM_PERM >= self.similarity
+           for candidate in candidates):
+      self.near += 1
+    self.signatures[key] = (signature, bands)
+    for band in bands:
+      self.buckets.setdefault(band, set()).add(key)
+    if len(self.signatures) > self.max_entries:
+      evicted, (_, evicted_bands) = self.signatures.popitem(last=False)
+      for band in evicted_bands:
+        self.buckets[band].discard(evicted)
+        if not self.buckets[band]:
+          del self.buckets[band]
+
+  def detect(self, batches: list, generate) -> list:
+    """
+    responses for the batches: only the batches not seen before (one per duplicate)
+    are passed to generate (list of batches -> list of responses)
+    """
+    keys = []
+    missing = {}   # hash -> first batch with that hash
+    for batch in batches:
+      normalized = normalize(batch)
+      key = hashlib.sha1(normalized.encode()).digest()
+      keys.append(key)
+      if key in self.responses:
+        self.responses.move_to_end(key)
+      elif key not in missing:
+        missing[key] = batch
+        if self.similarity < 1:
+          self.index(key, normalized)
+    found = {key: self.responses[key] for key in keys if key not in missing}
+    if missing:
+      found.update(zip(missing, generate(list(missing.values()))))
+      for key in missing:
+        self.responses[key] = found[key]
+      while len(self.responses) > self.max_entries:
+        self.responses.popitem(last=False)
+    self.batches += len(batches)
+    self.avoided += len(batches) - len(missing)
+    self.unique += len(missing)
+    return [found[key] for key in keys]
+
+  def stats(self) -> str:
+    rate = 100 * self.avoided / self.batches if self.batches else 0
+    report = f"dedup: {self.avoided} of {self.batches} inferences avoided ({rate:.1f}%), {self.unique} unique batches"
+    if self.similarity < 1:
+      report += f", {self.near} near-duplicates (inferred on their own text)"
+    return report
@@ -0,0 +1,95 @@
+import re
+
+# capitalized words that alone do not suggest sensitive data
+STOPWORDS = {
+  "the", "this", "that", "these", "those", "a", "an", "and", "or", "but", "if", "in", "on", "at", "to", "for",
+  "of", "by", "with", "from", "as", "is", "are", "was", "were", "be", "it", "its", "we", "our", "you", "your",
+  "he", "she", "they", "their", "i", "any", "all", "no", "not", "each", "such", "upon", "under", "unless",
+  "page", "section", "article", "clause", "paragraph", "agreement", "contract", "terms", "conditions", "party",
+  "parties", "company", "customer", "client", "provider", "services", "service", "date", "name", "signature",
+  "total", "table", "note", "notes", "annex", "appendix", "schedule", "whereas", "hereby", "herein", "hereof",
+  "now", "therefore", "however", "notwithstanding", "subject", "pursuant", "law", "act", "policy", "privacy",
+}
+
+# common words that start a sentence: capitalized only because of their position
+SENTENCE_WORDS = {
+  "there", "here", "what", "when", "where", "which", "who", "how", "why", "while", "after", "before", "during",
+  "also", "then", "thus", "since", "although", "because", "following", "according", "please", "thank", "thanks",
+  "yes", "other", "some", "many", "most", "one", "two", "first", "second", "finally", "further", "moreover",
+  "in", "on", "for", "as", "if", "upon", "until", "within", "without", "between", "about", "over",
+  "dear", "kind", "best", "regards", "sincerely", "yours", "see", "refer", "let", "do", "does", "did", "has", "have",
+  "had", "will", "shall", "may", "must", "can", "should", "would", "could", "only", "both", "every", "my", "his", "her",
+}
+
+# abbreviations whose period does not end the sentence (titles, initials are handled apart)
+ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "mt", "gen", "col", "capt", "rev", "hon",
+                 "dott", "dott.ssa", "avv", "ing", "sig", "sig.ra", "geom", "arch", "rag", "no", "nr", "vs", "etc", "e.g", "i.e"}
+
+PLACEHOLDER = re.compile(r"\[[A-Z_]+\]")   # values masked by the pre-detectors
+TOKEN = re.compile(r"[A-Za-z0-9@'_-]+")
+
+
+class ChunkGate:
+  """
+  Cheap CPU-side scoring of a batch to skip the LLM on batches without candidates of sensitive data.
+  The score counts the signals in the batch: capitalized words (not stopwords, nor common words starting a sentence),
+  numbers of 3+ digits, tokens mixing letters and digits, "@", and tokens of previously detected words (x2).
+  Batches scoring less than threshold are not sent to the LLM (0 sends everything).
+  """
+  def __init__(self, threshold: int, lexicon_words=()):
+    self.threshold = threshold
+    self.lexicon = set()
+    self.learn(lexicon_words)
+    self.scored = 0
+    self.skipped = 0
+
+  def learn(self, words) -> None:
+    """
+    adds the tokens of detected words to the lexicon
+    """
+    for word in words:
+      self.lexicon.update(token.lower() for token in TOKEN.findall(word) if len(token) > 2 and token.lower() not in STOPWORDS)
+
+  def score(self, batch: str) -> int:
+    text = PLACEHOLDER.sub(" ", batch)
+    score = 0
+    for match in TOKEN.finditer(text):
+      token = match.group()
+      lowered = token.lower()
+      if lowered in self.lexicon:
+        score += 2
+      elif "@" in token or (any(char.isdigit() for char in token) and (any(char.isalpha() for char in token) or len(token) > 2)):
+        score += 1
+      elif token[0].isupper() and lowered not in STOPWORDS and not (lowered in SENTENCE_WORDS and sentence_start(text, match.start())):
+        score += 1
+      if score >= self.threshold:
+        break
+    return score
+
+  def select(self, batches: list) -> list:
+    """
+    True for the batches to send to the LLM
+    """
+    selected = [self.score(batch) >= self.threshold for batch in batches]
+    self.scored += len(batches)
+    self.skipped += selected.count(False)
+    return selected
+
+  def stats(self) -> str:
+    rate = 100 * self.skipped / self.scored if self.scored else 0
+    return f"gate: {self.skipped} of {self.scored} batches skipped ({rate:.1f}%), threshold {self.threshold}"
+
+
+def sentence_start(text: str, idx: int) -> bool:
+  """
+  True if the character at idx starts a sentence: the previous one is .!? (not the period of an abbreviation or an initial)
+  """
+  idx -= 1
+  while idx >= 0 and text[idx].isspace():
+    idx -= 1
+  if idx < 0:
+    return True
+  if text[idx] == ".":
+    word = re.search(r"[\w.]*$", text[:idx]).group().lower()
+    return not (word in ABBREVIATIONS or (len(word) == 1 and word.isalpha()))
+  return text[idx] in "!?"
@@ -0,0 +1,142 @@
+import time
+import queue
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from PDFProcessor.PDFProcessor import PDFProcessor, detect_pool
+
+DONE = None   # end of the extraction stream
+
+
+def extract_document(conf: dict, pdf_path, output_pdf_path) -> tuple:
+  """
+  extraction stage (runs in a worker process): returns the document with its batches and the time spent
+  """
+  start = time.perf_counter()
+  doc = PDFProcessor(conf, pdf_path, output_pdf_path)
+  doc.prepare_batches()
+  return doc, time.perf_counter() - start
+
+
+def write_document(doc: PDFProcessor) -> float:
+  """
+  writing stage (runs in a worker process): saves the words and the highlighted PDF, returns the time spent
+  """
+  start = time.perf_counter()
+  doc.save_and_highlight()
+  return time.perf_counter() - start
+
+
+class DryRunPipeline:
+  """
+  Staged dry-run: a pool of extractor processes feeds a bounded queue consumed by the inference stage
+  (main process, pooling documents up to MAX_POOL_SEQUENCES batches), finished documents go to a pool of writer processes.
+  The bounded queue and the limit on pending writes give back-pressure to the faster stages.
+  """
+  def __init__(self, conf: dict, llm, temperature: float, cache=None, dictionary=None, gate=None, dedup=None):
+    self.conf = conf
+    self.llm = llm
+    self.temperature = temperature
+    self.cache = cache
+    self.dictionary = dictionary
+    self.gate = gate
+    self.dedup = dedup
+    self.stats = {"documents": 0, "failed": 0, "extract": 0.0, "inference": 0.0, "inference_wait": 0.0, "write": 0.0, "wall": 0.0}
+
+  def run(self, jobs: list) -> None:
+    """
+    jobs: list of (pdf_path, output_pdf_path)
+    """
+    start = time.perf_counter()
+    extracted = queue.Queue(maxsize=self.conf["PIPELINE_QUEUE_SIZE"])
+    context = multiprocessing.get_context("spawn")   # never fork a process holding the CUDA context
+    with ProcessPoolExecutor(self.conf["EXTRACT_WORKERS"], mp_context=context) as extractors, \
+         ProcessPoolExecutor(self.conf["WRITE_WORKERS"], mp_context=context) as writers:
+      producer = threading.Thread(target=self.produce, args=(extractors, jobs, extracted), daemon=True)
+      producer.start()
+
+      writes = set()
+      finished = False
+      while not finished:
+        wait_start = time.perf_counter()
+        docs = [extracted.get()]
+        self.stats["inference_wait"] += time.perf_counter() - wait_start
+        # pool the documents already extracted, up to the sequence budget
+        pooled = len(docs[0].batches) if docs[0] is not DONE else 0
+        while docs[-1] is not DONE and pooled < self.conf["MAX_POOL_SEQUENCES"]:
+          try:
+            docs.append(extracted.get_nowait())
+          except queue.Empty:
+            break
+          pooled += len(docs[-1].batches) if docs[-1] is not DONE else 0
+        if docs[-1] is DONE:
+          finished = True
+          docs.pop()
+        if not docs:
+          continue
+
+        inference_start = time.perf_counter()
+        for doc in docs:
+          doc.cache = self.cache
+          doc.dictionary = self.dictionary
+          doc.gate = self.gate
+          doc.dedup = self.dedup
+        detect_pool(self.llm, docs, self.temperature)
+        self.stats["inference"] += time.perf_counter() - inference_start
+
+        for doc in docs:
+          writes.add(writers.submit(write_document, doc))
+        while len(writes) > 2 * self.conf["WRITE_WORKERS"]:
+          done, writes = wait(writes, return_when=FIRST_COMPLETED)
+          self.collect_writes(done)
+      self.collect_writes(wait(writes).done)
+      producer.join()
+    self.stats["wall"] = time.perf_counter() - start
+
+  def produce(self, extractors, jobs: list, extracted: queue.Queue) -> None:
+    """
+    extraction stage: keeps at most EXTRACT_WORKERS + PIPELINE_QUEUE_SIZE documents in flight
+    and queues every document as soon as its extraction finishes
+    """
+    in_flight = set()
+    limit = self.conf["EXTRACT_WORKERS"] + self.conf["PIPELINE_QUEUE_SIZE"]
+    pending = iter(jobs)
+    try:
+      while True:
+        for pdf_path, output_pdf_path in itertools.islice(pending, limit - len(in_flight)):
+          in_flight.add(extractors.submit(extract_document, self.conf, pdf_path, output_pdf_path))
+        if not in_flight:
+          break
+        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        self.enqueue(done, extracted)
+    finally:
+      extracted.put(DONE)
+
+  def enqueue(self, futures, extracted: queue.Queue) -> None:
+    for future in futures:
+      try:
+        doc, seconds = future.result()
+      except Exception as e:
+        print(f"extraction failed: {e}")
+        self.stats["failed"] += 1
+        continue
+      self.stats["extract"] += seconds
+      extracted.put(doc)   # blocks while the inference stage is behind
+
+  def collect_writes(self, futures) -> None:
+    for future in futures:
+      try:
+        self.stats["write"] += future.result()
+        self.stats["documents"] += 1
+      except Exception as e:
+        print(f"writing failed: {e}")
+        self.stats["failed"] += 1
+
+  def report(self) -> str:
+    stats = self.stats
+    wall = stats["wall"] or 1
+    return (f"pipeline: {stats['documents']} documents ({stats['failed']} failed) in {stats['wall']:.2f}s\n"
+            f"  extract:   {stats['extract']:.2f}s busy, {100 * stats['extract'] / (wall * self.conf['EXTRACT_WORKERS']):.1f}% utilization of {self.conf['EXTRACT_WORKERS']} workers\n"
+            f"  inference: {stats['inference']:.2f}s busy, {100 * stats['inference'] / wall:.1f}% utilization, {stats['inference_wait']:.2f}s waiting for input\n"
+            f"  write:     {stats['write']:.2f}s busy, {100 * stats['write'] / (wall * self.conf['WRITE_WORKERS']):.1f}% utilization of {self.conf['WRITE_WORKERS']} workers")
@@ -0,0 +1,73 @@
+import fcntl
+from pathlib import Path
+
+
+class ObfuscationDictionary:
+  """
+  Corpus-wide entity -> replacement store shared by all the documents (and workers) of a run.
+  Every distinct entity is obfuscated once and then reused, so it gets the same fake value in every file.
+
+  format: word\\tobfuscated_word\\n (append only, the first entry of a word wins)
+  """
+  def __init__(self, path: Path):
+    self.path = Path(path)
+    self.entries = {}
+    self.offset = 0   # bytes of the file already loaded
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    self.load()
+
+  def load(self) -> None:
+    """
+    bulk load of the entries (only the ones appended since the last load)
+    """
+    if not self.path.exists():
+      return
+    with open(self.path, "rb") as f:
+      fcntl.flock(f, fcntl.LOCK_SH)
+      try:
+        self._read_new(f)
+      finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+  def _read_new(self, f) -> None:
+    f.seek(self.offset)
+    data = f.read()
+    end = data.rfind(b"\n") + 1   # ignore a partially written last line
+    for line in data[:end].decode().splitlines():
+      word, _, replacement = line.partition("\t")
+      self.entries.setdefault(word, replacement)
+    self.offset += end
+
+  def get(self, word: str) -> str:
+    return self.entries.get(clean(word))
+
+  def missing(self, words: list) -> list:
+    """
+    words (deduplicated, in order) without a replacement in the dictionary
+    """
+    return [word for word in dict.fromkeys(words) if clean(word) not in self.entries]
+
+  def add(self, replacements: dict) -> dict:
+    """
+    Appends the new replacements under an exclusive lock.
+    Entries written in the meantime by other workers take precedence, the effective mapping is returned
+    """
+    with open(self.path, "ab+") as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      try:
+        self._read_new(f)
+        new = {clean(word): clean(replacement) for word, replacement in replacements.items() if clean(word) not in self.entries}
+        if new:
+          f.seek(0, 2)
+          f.write("".join(f"{word}\t{replacement}\n" for word, replacement in new.items()).encode())
+          f.flush()
+          self.offset = f.tell()
+          self.entries.update(new)
+      finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+    return {word: self.entries.get(clean(word)) for word in replacements}
+
+
+def clean(value: str) -> str:
+  """ tabs and newlines are the separators of the dictionary file """
+  return value.replace("\t", " ").replace("\n", " ")
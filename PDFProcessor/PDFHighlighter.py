@@ -1,46 +1,53 @@
-import os
-import re
 from pathlib import Path
 import fitz
+from PDFProcessor.WordMatcher import WordMatcher
+from PDFProcessor.PageIndex import PageIndex
+from PDFProcessor.PageParallel import split_pages, process_in_parallel
 
 class PDFHighlighter:
-  def __init__(self, pdf_path: Path, words: list, obf_words: list):
+  def __init__(self, pdf_path: Path, words: list, obf_words: list, doc: fitz.Document = None, matcher: WordMatcher = None,
+               page_index: PageIndex = None):
     self.pdf_path = pdf_path
     self.words = words
     self.obf_words = obf_words
+    self.doc = doc   # document already opened by the text extraction, if any
+    self.matcher = matcher if matcher is not None else WordMatcher(words)
+    self.page_index = page_index   # the pages without any word are skipped
+    self.pages_skipped = 0
+    self.hits = {}   # word -> [[page number, [[x0, y0, x1, y1] of each line]], ...] of its occurrences
 
-  def highlight(self, output_path, color=(1, 1, 0), opacity=0.2) -> None:
+  def highlight(self, output_path, color=(1, 1, 0), opacity=0.2, workers: int = 0) -> None:
     """
-    highlights the words to redact in the PDF using PyMuPDF library
+    highlights the whole-word occurrences of the words to redact in the PDF using PyMuPDF library,
+    in page ranges on up to workers processes for long PDFs
     """
-    doc = fitz.open(self.pdf_path)
-    for page_num in doc:
-      page_text = page_num.get_text()
-      for target_word in self.words:
-        text_instances = page_num.search_for(target_word)
-        #print(text_instances)
-        if text_instances:
-          for inst in text_instances:
-            page_num.draw_rect(inst, color=color, fill=color, overlay=True, stroke_opacity=0, fill_opacity=opacity)
+    doc = self.doc if self.doc is not None else fitz.open(self.pdf_path)
+    numbers = self.page_index.pages_to_visit(doc.page_count, self.words) if self.page_index else list(range(doc.page_count))
+    self.pages_skipped = doc.page_count - len(numbers)
+    if self.pages_skipped:
+      print(f"page index: {self.pages_skipped} of {doc.page_count} pages skipped")
+
+    workers = split_pages(doc, workers, len(numbers))
+    if workers:
+      page_count = doc.page_count
+      doc.close()
+      self.doc = None
+      doc, results = process_in_parallel(self, "highlight_pages", self.pdf_path, page_count, workers, numbers, color, opacity)
+      self.hits = {word: [hit for hits in results for hit in hits[word]] for word in self.words}
+    else:
+      self.hits = self.highlight_pages(doc, numbers, color, opacity)
     doc.save(output_path)
+    doc.close()
 
-  def highlight_new(self, output_path, color=(1, 1, 0), opacity=0.2) -> None:
+  def highlight_pages(self, doc: fitz.Document, numbers: list, color: tuple, opacity: float) -> dict:
     """
-    Highlights the words to redact in the PDF using the PyMuPDF library,
-    ensuring the word is not part of another word.
+    highlights the words on the given pages, returns word -> [[page number, [[x0, y0, x1, y1] of each line]], ...]
     """
-    doc = fitz.open(self.pdf_path)
-    
-    patterns = [re.compile(rf"\b{re.escape(word)}\b") for word in self.words]
-
-    for page in doc:
-      text = page.get_text("text")
-      for pattern in patterns:
-        matches = list(pattern.finditer(text))
-        for match in matches:
-          areas = page.search_for(match.group())
-          if areas:
-            for area in areas:
-              page.draw_rect(area, color=color, fill=color, overlay=True, stroke_opacity=0, fill_opacity=opacity)
-      page.apply_redactions()
-    doc.save(output_path)
+    hits = {word: [] for word in self.words}
+    for number in numbers:
+      page = doc[number]
+      for index, rects in self.matcher.page_hits(page):
+        for rect in rects:
+          page.draw_rect(rect, color=color, fill=color, overlay=True, stroke_opacity=0, fill_opacity=opacity)
+        hits[self.words[index]].append([number, [[round(coord, 2) for coord in rect] for rect in rects]])
+    return hits
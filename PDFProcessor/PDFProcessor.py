@@ -1,164 +1,620 @@
 import os
 import re
+import json
+import time
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from llm.llm import LLMChat
+from llm.cache import ResponseCache
 import llm.prompt as prompt
-from PDFProcessor.PDFTextExtractor import PDFTextExtractor
+from PDFProcessor.PDFTextExtractor import PDFTextExtractor, iter_sentences, iter_batches, iter_token_batches, load_token_counter, split_in_half
 from PDFProcessor.PDFHighlighter import PDFHighlighter
 from PDFProcessor.PDFRedactor import PDFRedactor
+from PDFProcessor.ObfuscationDictionary import ObfuscationDictionary, clean
+from PDFProcessor.TextCache import TextCache
+from PDFProcessor.WordMatcher import WordMatcher
+from PDFProcessor.PageIndex import PageIndex
+from PDFProcessor.PIIDetector import PIIDetector, is_placeholder
+from PDFProcessor.ChunkGate import ChunkGate
+from PDFProcessor.ChunkDedup import ChunkDedup
 import logging, logging.config
-import pymupdf4llm
-from tqdm import tqdm
 from datetime import datetime
+import fitz
+
+# bump when the format of the saved geometry changes (older files are ignored)
+GEOMETRY_VERSION = 2
+
 
 class PDFProcessor:
-  def __init__(self, conf: dict, pdf_path: Path, output_pdf_path: Path):
+  def __init__(self, conf: dict, pdf_path: Path, output_pdf_path: Path, cache: ResponseCache = None,
+               dictionary: ObfuscationDictionary = None, gate: ChunkGate = None, dedup: ChunkDedup = None):
     self.conf = conf
+    self.cache = cache
+    self.dictionary = dictionary
+    self.gate = gate
+    self.dedup = dedup
     self.pdf_path = pdf_path
     self.output_pdf_path = output_pdf_path
+    self.words_name = extract_filename(pdf_path)   # name of the words and geometry files in WORDS_PATH
     self.words = []
     self.obf_words = []
+    self.entity_types = {}   # word -> entity type (when known)
+    self.batches = None   # batches of prepare_batches, None until the document is prepared
+    self.document = None   # PyMuPDF document opened by the extraction, reused by the highlighter
+    self.page_index = None   # token -> pages index built by the extraction
+    self.pdf_sha256 = None   # hash of the PDF content, computed once (file_hash)
+
+  def __getstate__(self):
+    """
+    the run-wide caches stay in the main process when a document is sent to a worker process
+    """
+    state = self.__dict__.copy()
+    state["cache"] = None
+    state["dictionary"] = None
+    state["gate"] = None
+    state["dedup"] = None
+    state["document"] = None
+    return state
 
   # File system access methods
   def save_words(self, output_path: Path) -> None:
     """
     saves the words to redact in a file in cache folder
-    format: word, obfuscated_word\n
+    format: word\tobfuscated_word\n (tab separated, entities may contain commas)
     """
     with open(output_path, "w") as f:
       for idx in range(len(self.words)):
-        f.write(f"{self.words[idx]}, {self.obf_words[idx]}\n")
+        f.write(f"{clean(self.words[idx])}\t{clean(self.obf_words[idx])}\n")
 
   def load_words(self, input_path: Path) -> None:
     """ 
     loads the words to redact from a file in cache folder
-    format: word, obfuscated_word\n
+    format: word\tobfuscated_word\n, files without any tab are read in the old format word, obfuscated_word\n
+    words added by hand without a replacement take the one of the corpus dictionary
     """
     with open(input_path, "r") as f:
-      content = f.readlines()
-      for line in content:
-        self.words.append(line.split(", ")[0])
-        self.obf_words.append(line.split(", ")[1])
+      content = f.read().splitlines()
+    separator = "\t" if any("\t" in line for line in content) else ", "
+    for line in content:
+      word, sep, replacement = line.partition(separator)
+      if not sep and self.dictionary is not None and self.dictionary.get(word) is not None:
+        replacement = self.dictionary.get(word)
+      self.words.append(word)
+      self.obf_words.append(replacement)
 
   # Word processing method
   def apply_filters(self) -> None:
     """
     This function is used to apply filters to the detected words.
-    removing words with not allowed characters and adding new date formats
+    removing words with not allowed characters or an excluded entity type and adding new date formats
     """
+    words = []
     for word in self.words:
       # Check for not allowed chars
       if any(char in word for char in self.conf["NOT_ALLOWED_CHARS"]):
-        # remove the word
-        self.words.remove(word)
-      
+        continue
+
+      # Check for excluded entity types
+      if self.entity_types.get(word) in self.conf["EXCLUDED_TYPES"]:
+        continue
+      words.append(word)
+
       # Check for date formats
-      new_date = new_date_format(word)
+      new_date = new_date_format(word) if self.entity_types.get(word, "DATE") == "DATE" else None
       if new_date:
-        self.words.append(new_date)
+        words.append(new_date)
+        self.entity_types.setdefault(new_date, "DATE")
+    self.words = list(dict.fromkeys(words))
+
+  def file_hash(self) -> str:
+    """
+    sha256 of the PDF, read once per document (geometry, text cache and page index all use it)
+    """
+    if self.pdf_sha256 is None:
+      self.pdf_sha256 = TextCache.file_hash(self.pdf_path)
+    return self.pdf_sha256
+
+  def save_geometry(self, output_path: Path, hits: dict) -> None:
+    """
+    saves the rects of the occurrences of the words found by the highlight, with the hash of the PDF they belong to
+    """
+    with open(output_path, "w") as f:
+      json.dump({"version": GEOMETRY_VERSION, "pdf_sha256": self.file_hash(), "hits": hits}, f)
+
+  def load_geometry(self, input_path: Path) -> dict:
+    """
+    loads the rects of the words saved by the dry-run, None if missing, of an older format or saved for a different PDF
+    """
+    try:
+      with open(input_path, "r") as f:
+        geometry = json.load(f)
+    except FileNotFoundError:
+      return None
+    if geometry.get("version") != GEOMETRY_VERSION:   # older files have a flat list of rects per word
+      print(f"{input_path} has an older format, searching the words again")
+      return None
+    if geometry["pdf_sha256"] != self.file_hash():
+      print(f"{self.pdf_path} changed since the dry-run, searching the words again")
+      return None
+    return geometry["hits"]
 
   # LLM inference methods
+  def prepare_batches(self) -> list:
+    """
+    Extracts the text of the PDF and splits it into batches for the LLM
+    """
+    self.batches = list(self.iter_batches())
+    return self.batches
+
+  def iter_batches(self):
+    """
+    Streams the batches of the PDF: pages -> sentences -> batches,
+    only the current page and batch are held in memory
+    """
+    text_cache = TextCache(self.conf['WORDS_PATH'] / "text") if self.conf['TEXT_CACHE'] else None
+    text_processor = PDFTextExtractor(self.pdf_path, self.conf['EXTRACTION_ENGINE'], self.conf['EXTRACT_PAGE_WORKERS'], text_cache,
+                                      self.file_hash() if text_cache is not None else None)
+    pages = text_processor.iter_pages()
+    if self.conf['PRE_DETECTION']:
+      pages = (self.pre_detect(re.sub(r'\s{2,}', ' ', page)) for page in pages)
+    sentences = iter_sentences(pages)
+    if self.conf['BATCH_MODE'] == "tokens":
+      count_tokens = load_token_counter(self.conf['TOKENIZER'])
+      yield from iter_token_batches(sentences, count_tokens, self.conf['TOKEN_BUDGET'])
+    else:
+      yield from iter_batches(sentences, self.conf['MAX_BATCH_SIZE'])
+    self.document = text_processor.doc
+    self.page_index = text_processor.page_index
+
+  def pre_detect(self, text: str) -> str:
+    """
+    Adds the structured data found by the pattern detectors to words
+    and returns the text for the LLM (with the hits masked if MASK_PRE_DETECTED)
+    """
+    detector = PIIDetector()
+    hits = detector.detect(text)
+    for _, _, value, entity_type in hits:
+      self.words.append(value)
+      self.entity_types.setdefault(value, entity_type)
+    if os.getenv("DEBUG")=="1": print(f"pre-detected: {list(dict.fromkeys(hit[2] for hit in hits))}")
+    return detector.mask(text, hits) if self.conf['MASK_PRE_DETECTED'] else text
+
   def process_batches(self, detective: LLMChat, batches: list, temperature: int) -> None:
     """
-    Feeds the batches to LLM and processes the response
+    Feeds all the batches to LLM in a single generate call and processes the responses
+    """
+    if not batches:
+      return
+    responses = detect(detective, self.cache, batches, temperature, self.conf, self.gate, self.dedup)
+    self.add_responses(responses)
+
+  def add_responses(self, responses: list) -> None:
+    """
+    Processes the LLM responses to the batches of this document
 
     Example response: "word1, word2, word3, None, word4, word5"
+    or with OUTPUT_FORMAT json: [{"text": "word1", "type": "NAME"}, ...]
     
     Removes None, duplicates and words shorter than 3 characters
-    Adds the responses to words list
+    Adds the responses to words list (and their type to entity_types)
     """
-    total_batches = len(batches)
-    for idx, batch in tqdm(enumerate(batches), total=total_batches, desc="elaborating batches", dynamic_ncols=True):
-      resp = detective.generate_response(prompt.DETECTION_INSTRUCTION_V8, prompt.EXAMPLES_ARR, batch, temperature)
+    for idx, resp in enumerate(responses):
       if os.getenv("DEBUG") == "1":
-        print(f"llm response: n {idx} of {len(batches)} \n{resp}")
-      splitted = [item.strip() for item in resp.split(",")]
-      for item in splitted:
-        if item != "None" and len(item) > self.conf['MIN_LENGTH']:   # Ignore short words and "None"
+        print(f"llm response: n {idx} of {len(responses)} \n{resp}")
+      for item, entity_type in parse_detection(resp, self.conf['OUTPUT_FORMAT']):
+        if item != "None" and len(item) > self.conf['MIN_LENGTH'] and not is_placeholder(item):   # Ignore short words, "None" and masks
           self.words.append(item)
+          if entity_type:
+            self.entity_types.setdefault(item, entity_type)
     self.words = list(set(self.words))  # Remove duplicates
+    if self.gate is not None:
+      self.gate.learn(self.words)
 
   def obfuscate_words(self, model: LLMChat, temp=1) -> None:
     """
-    Obfuscates the words in doc object using LLM model
-    Adds the response to obf_words list
+    Obfuscates the words in doc object using LLM model (one batched generate call)
+    Adds the responses to obf_words list, aligned with words
     """
-    for word in self.words:
-      response = model.generate_response(prompt.REDACTION_INSTRUCTION_V1, prompt.EXAMPLES_ARR_REDACTION, word, temperature=temp)
-      if os.getenv("DEBUG")=="1": print(response)
-      #assert word != response  # Response must be different from the input
-      if word == response:
-        response = " "
-      self.obf_words.append(response)
+    self.obf_words += obfuscate(model, self.dictionary, self.words, temp)
 
   # PDF pipeline
-  def process_pdf(self, llm: LLMChat, temperature: int, mode: str) -> None:
+  def matcher(self) -> WordMatcher:
     """
-    Main pipeline for PDF processing
+    multi-word matcher of the words of the document, shared by highlight and redaction
     """
-    if mode == "dry-run":
-      text_processor = PDFTextExtractor(self.pdf_path)
-      
-      # Extract text
-      text = text_processor.extract_text()
-      batches = text_processor.split_text_into_batches(text, self.conf['MAX_BATCH_SIZE'])
-    
-      # LLM inference
-      self.process_batches(llm, batches, temperature)
-      if os.getenv("DEBUG")=="1": print(self.words)
+    return WordMatcher(self.words, self.conf['MATCH_IGNORE_CASE'], self.conf['MATCH_IGNORE_WHITESPACE'])
 
-      # Apply constraints to detected words
-      self.apply_filters()
-      if os.getenv("DEBUG")=="1": print(f"after filter: {self.words}")
-    
-      # Obfuscate words
-      if self.conf['TARGET_WORDS'] == "None":
-        print("obfuscating words...")
-        self.obfuscate_words(llm)
-        if os.getenv("DEBUG")=="1": print(f"obfuscated words: {self.obf_words}")
-      else:
-        for word in self.words:
-          self.obf_words.append(self.conf['TARGET_WORDS'])
+  def load_page_index(self) -> PageIndex:
+    """
+    Page index stored with the extracted text in the text cache, None if the PDF was not extracted
+    """
+    if not self.conf['TEXT_CACHE']:
+      return None
+    text_cache = TextCache(self.conf['WORDS_PATH'] / "text")
+    return text_cache.get_index(PDFTextExtractor(self.pdf_path, self.conf['EXTRACTION_ENGINE'], 0, text_cache, self.file_hash()).cache_key())
 
-      # Save words with the respective obfuscation to the fs
-      print(f"saving words to {self.conf['WORDS_PATH']}...")
-      filename = extract_filename(self.pdf_path)
-      self.save_words(self.conf['WORDS_PATH'] / f"{filename}.txt")
+  def filter_words(self) -> None:
+    """
+    Applies the constraints to the detected words
+    """
+    if os.getenv("DEBUG")=="1": print(self.words)
+    self.apply_filters()
+    if os.getenv("DEBUG")=="1": print(f"after filter: {self.words}")
 
-      # highlight the words to redact
-      print("performing highlight...")
-      highlighter = PDFHighlighter(self.pdf_path, self.words, self.obf_words) 
-      highlighter.highlight(self.output_pdf_path, self.conf['HIGHLIGHT_COLOR'], opacity=self.conf["OPACITY"])
+  def save_and_highlight(self) -> None:
+    """
+    Saves words with the respective obfuscation to the fs and highlights them in the output PDF
+    """
+    print(f"saving words to {self.conf['WORDS_PATH']}...")
+    self.save_words(self.conf['WORDS_PATH'] / f"{self.words_name}.txt")
+
+    # highlight the words to redact
+    print("performing highlight...")
+    highlighter = PDFHighlighter(self.pdf_path, self.words, self.obf_words, self.document, self.matcher(), self.page_index)
+    highlighter.highlight(self.output_pdf_path, self.conf['HIGHLIGHT_COLOR'], opacity=self.conf["OPACITY"], workers=self.conf['PAGE_WORKERS'])
+    self.document = None
+    self.save_geometry(self.conf['WORDS_PATH'] / f"{self.words_name}.geometry.json", highlighter.hits)
+
+  def complete_dry_run(self, llm: LLMChat) -> None:
+    """
+    Dry-run steps following the detection: filters, obfuscation, cache and highlight
+    """
+    self.filter_words()
+  
+    # Obfuscate words
+    if self.conf['TARGET_WORDS'] == "None":
+      print("obfuscating words...")
+      self.obfuscate_words(llm)
+      if os.getenv("DEBUG")=="1": print(f"obfuscated words: {self.obf_words}")
+    else:
+      for word in self.words:
+        self.obf_words.append(self.conf['TARGET_WORDS'])
+
+    self.save_and_highlight()
+
+  def redact(self) -> int:
+    """
+    Redacts the PDF with the words saved by the dry-run (FileNotFoundError if there are none),
+    returns the number of pages of the PDF (None with the pdf_redactor method)
+    """
+    # Load words from cache
+    print(f"loading obfuscated words from {self.conf['WORDS_PATH']}...")
+    self.load_words(self.conf['WORDS_PATH'] / f"{self.words_name}.txt")
+    if self.conf["TARGET_WORDS"] != "None":
+      self.obf_words = [self.conf["TARGET_WORDS"] for _ in range(len(self.words))]
+    if os.getenv("DEBUG") == "1": print(f"obfuscated words: {self.words} --> {self.obf_words}")
+
+    # Perform redaction on the PDF
+    print("performing PDF redaction...")
+    geometry = self.load_geometry(self.conf['WORDS_PATH'] / f"{self.words_name}.geometry.json") if self.conf['REPLAY_GEOMETRY'] else None
+    redactor = PDFRedactor(self.pdf_path, self.words, self.obf_words, self.matcher(), self.load_page_index(), geometry)
+    if self.conf["REDACTION"] == "pdf_redactor":
+      redactor.redact_with_pdf_redactor(self.output_pdf_path)
+    else:
+      redactor.redact_words(self.output_pdf_path,
+                            self.conf["METADATA"],
+                            self.conf["BACKGROUND_COLOR"],
+                            self.conf["TEXT_COLOR"],
+                            self.conf["FONT_SIZE"],
+                            self.conf["PAGE_WORKERS"])
+    return redactor.page_count
+
+  def process_pdf(self, llm: LLMChat, temperature: int, mode: str) -> None:
+    """
+    Main pipeline for PDF processing
+    """
+    if mode == "dry-run":
+      # Extract text and run the LLM inference on the batches as they are produced
+      batches = self.iter_batches()
+      while True:
+        chunk = list(itertools.islice(batches, self.conf['MAX_POOL_SEQUENCES']))
+        if not chunk:
+          break
+        self.process_batches(llm, chunk, temperature)
+      self.complete_dry_run(llm)
 
     elif mode == "redaction":
       try:
-        # Load words from cache
-        print(f"loading obfuscated words from {self.conf['WORDS_PATH']}...")
-        self.load_words(self.conf['WORDS_PATH'] / f"{extract_filename(self.pdf_path)}.txt")
-        if self.conf["TARGET_WORDS"] != "None":
-          self.obf_words = [self.conf["TARGET_WORDS"] for _ in range(len(self.words))]
-        if os.getenv("DEBUG") == "1": print(f"obfuscated words: {self.words} --> {self.obf_words}")
-
-        # Perform redaction on the PDF
-        print("performing PDF redaction...")
-        redactor = PDFRedactor(self.pdf_path, self.words, self.obf_words)
-        if self.conf["REDACTION"] == "pdf_redactor":
-          redactor.redact_with_pdf_redactor(self.output_pdf_path)
-        else:
-          redactor.redact_words(self.output_pdf_path,
-                                self.conf["METADATA"],
-                                self.conf["BACKGROUND_COLOR"],
-                                self.conf["TEXT_COLOR"],
-                                self.conf["FONT_SIZE"])
-      
+        self.redact()
       except FileNotFoundError:
         print(f"{self.pdf_path} not found in cache, try running in dry-run mode first")
-    
+
     else:
       raise ValueError("Invalid mode, please choose between 'dry-run' and 'redaction'")
 
 
 
+# corpus dictionary of a redaction worker process, loaded once by init_redaction_worker
+worker_dictionary = None
+
+
+def init_redaction_worker(conf: dict) -> None:
+  global worker_dictionary
+  worker_dictionary = ObfuscationDictionary(conf['WORDS_PATH'] / "dictionary.tsv") if conf['CORPUS_DICTIONARY'] else None
+
+
+def redact_document(conf: dict, pdf_path: Path, output_pdf_path: Path) -> int:
+  """
+  Redaction of one PDF (runs in a worker process), returns its number of pages
+  """
+  pages = PDFProcessor(conf, pdf_path, output_pdf_path, dictionary=worker_dictionary).redact()
+  if pages is None:
+    with fitz.open(pdf_path) as pdf:
+      pages = pdf.page_count
+  return pages
+
+
+def redact_pool(conf: dict, jobs: list, workers: int) -> str:
+  """
+  Redaction of the PDFs of jobs [(pdf_path, output_pdf_path)] on workers processes, largest files first.
+  A failed PDF is reported and does not stop the others. Returns the throughput summary
+  """
+  jobs = sorted(jobs, key=lambda job: os.path.getsize(job[0]), reverse=True)
+  conf = dict(conf, PAGE_WORKERS=0)   # the documents already fill the processes, no page ranges inside them
+  start = time.perf_counter()
+  pages, size, failed = 0, 0, []
+  context = multiprocessing.get_context("spawn")
+  with ProcessPoolExecutor(workers, mp_context=context, initializer=init_redaction_worker, initargs=(conf,)) as pool:
+    futures = {pool.submit(redact_document, conf, pdf_path, output_pdf_path): pdf_path for pdf_path, output_pdf_path in jobs}
+    for future in as_completed(futures):
+      pdf_path = futures[future]
+      try:
+        pages += future.result()
+        size += os.path.getsize(pdf_path)
+      except FileNotFoundError:
+        failed.append(pdf_path)
+        print(f"{pdf_path} not found in cache, try running in dry-run mode first")
+      except Exception as e:
+        failed.append(pdf_path)
+        print(f"redaction of {pdf_path} failed: {type(e).__name__}: {e}")
+  elapsed = time.perf_counter() - start
+  return (f"redacted {len(jobs) - len(failed)} of {len(jobs)} PDFs on {workers} workers in {elapsed:.2f}s: "
+          f"{pages / elapsed:.1f} pages/s, {size / 2**20 / elapsed:.2f} MB/s"
+          + (f", failed: {', '.join(str(path) for path in failed)}" if failed else ""))
+
+
+def process_pool(llm: LLMChat, docs, temperature: int) -> None:
+  """
+  Dry-run of several documents sharing the detection generate calls,
+  every document is highlighted as soon as its detection is complete
+  """
+  def highlight(finished: list) -> None:
+    for doc in finished:
+      print(f"processing {doc.pdf_path}...")
+      doc.save_and_highlight()
+
+  detect_pool(llm, docs, temperature, highlight)
+
+
+def pool_batches(docs):
+  """
+  (doc, batch) of the docs in order, followed by (doc, None) at the end of each document
+  or by (doc, exception) if its extraction fails
+  """
+  for doc in docs:
+    try:
+      for batch in (doc.batches if doc.batches is not None else doc.iter_batches()):
+        yield doc, batch
+    except Exception as e:
+      yield doc, e
+      continue
+    yield doc, None
+
+
+def detect_pool(llm: LLMChat, docs, temperature: int, done=None, failed=None) -> None:
+  """
+  Detection, filters and obfuscation of several documents.
+  The batches of all docs are pooled (at most MAX_POOL_SEQUENCES prompts per call)
+  and the responses are mapped back to their document in submission order.
+  The batches of docs not prepared beforehand are streamed from their pages and docs may be an iterator:
+  a document is extracted only when the calls have room for its batches. After every call the documents
+  whose detection is complete are filtered, obfuscated and passed to done (list of docs).
+  With failed, a document whose extraction raises is passed to failed(doc, error) and dropped
+  """
+  pooled = pool_batches(docs)
+  responses, finished = {}, []
+  first = None
+  exhausted = False
+  while not exhausted:
+    chunk = []
+    exhausted = True
+    for doc, batch in pooled:
+      first = first or doc
+      if isinstance(batch, Exception):
+        if failed is None:
+          raise batch
+        chunk = [item for item in chunk if item[0] is not doc]
+        responses.pop(id(doc), None)
+        failed(doc, batch)
+      elif batch is None:
+        finished.append(doc)
+      else:
+        chunk.append((doc, batch))
+        if len(chunk) >= max(1, first.conf['MAX_POOL_SEQUENCES']):
+          exhausted = False
+          break
+
+    if chunk:
+      print(f"detection on {len(chunk)} batches from {len(set(id(doc) for doc, _ in chunk))} documents...")
+      results = detect(llm, first.cache, [batch for _, batch in chunk], temperature, first.conf, first.gate, first.dedup)
+      for (doc, _), resp in zip(chunk, results):
+        responses.setdefault(id(doc), []).append(resp)
+    if finished:
+      finish_detection(llm, finished, responses)
+      if done is not None:
+        done(finished)
+      finished = []
+
+
+def finish_detection(llm: LLMChat, docs: list, responses: dict) -> None:
+  """
+  Filters of the detected words of the docs and their obfuscation in one generate call
+  """
+  for doc in docs:
+    doc.add_responses(responses.pop(id(doc), []))
+    doc.filter_words()
+
+  if docs[0].conf['TARGET_WORDS'] == "None":
+    unique_words = sorted(set(word for doc in docs for word in doc.words))
+    print(f"obfuscating {len(unique_words)} words...")
+    replacements = dict(zip(unique_words, obfuscate(llm, docs[0].dictionary, unique_words)))
+  else:
+    replacements = None
+
+  for doc in docs:
+    doc.obf_words = [replacements[word] if replacements else doc.conf['TARGET_WORDS'] for word in doc.words]
+
+
+def detection_prompt(conf: dict) -> tuple:
+  """
+  (instruction, examples, JSON schema or None) of the detection task for the configured OUTPUT_FORMAT
+  """
+  if conf['OUTPUT_FORMAT'] == "json":
+    return prompt.DETECTION_INSTRUCTION_JSON, prompt.EXAMPLES_ARR_JSON, prompt.DETECTION_SCHEMA
+  return prompt.DETECTION_INSTRUCTION_V8, prompt.EXAMPLES_ARR, None
+
+
+def detect(llm: LLMChat, cache: ResponseCache, batches: list, temperature: int, conf: dict,
+           gate: ChunkGate = None, dedup: ChunkDedup = None) -> list:
+  """
+  Detection responses for the batches, consulting the persistent response cache first (if any).
+  Batches rejected by the gate get an empty response without calling the LLM,
+  duplicates of batches already inferred in the run reuse their response
+  """
+  if gate is not None:
+    selected = gate.select(batches)
+    sent = [batch for batch, keep in zip(batches, selected) if keep]
+    responses = iter(detect(llm, cache, sent, temperature, conf, None, dedup) if sent else [])
+    empty = "[]" if conf['OUTPUT_FORMAT'] == "json" else "None"
+    return [next(responses) if keep else empty for keep in selected]
+
+  if dedup is not None:
+    return dedup.detect(batches, lambda items: detect(llm, cache, items, temperature, conf))
+
+  instruction, examples, schema = detection_prompt(conf)
+  generate = lambda items: generate_detections(llm, items, temperature, conf)
+  if cache is None:
+    return generate(batches)
+  signature = llm.sampling_signature(temperature, conf['DETECTION_MAX_TOKENS'], schema)
+  return cache.generate(signature, instruction, examples, batches, generate)
+
+
+def generate_detections(llm: LLMChat, batches: list, temperature: int, conf: dict) -> list:
+  """
+  Detection responses for the batches. A response truncated by max_tokens (finish_reason "length")
+  is generated again on the two halves of its batch and the two responses are joined
+  """
+  instruction, examples, schema = detection_prompt(conf)
+  detector = PIIDetector()
+
+  def escalate(idx, completion) -> bool:
+    """
+    cascade: escalate unparseable responses and responses missing a value found by the pattern detectors.
+    With MASK_PRE_DETECTED the batches hold placeholders instead of those values (already in the words),
+    so only the first rule applies
+    """
+    if not is_parseable(completion.text, conf['OUTPUT_FORMAT']):
+      return True
+    if conf['PRE_DETECTION'] and conf['MASK_PRE_DETECTED']:
+      return False
+    found = " | ".join(text.lower() for text, _ in parse_detection(completion.text, conf['OUTPUT_FORMAT']))
+    return any(value.lower() not in found for _, _, value, _ in detector.detect(batches[idx]))
+
+  completions = llm.generate_completions(instruction, examples, batches, temperature, conf['DETECTION_MAX_TOKENS'], schema, escalate)
+  responses = [completion.text for completion in completions]
+  truncated = [idx for idx, completion in enumerate(completions)
+               if completion.finish_reason == "length" and len(split_in_half(batches[idx])) == 2]
+  if truncated:
+    print(f"{len(truncated)} truncated responses, splitting their batches...")
+    halves = [half for idx in truncated for half in split_in_half(batches[idx])]
+    half_responses = generate_detections(llm, halves, temperature, conf)
+    for n, idx in enumerate(truncated):
+      responses[idx] = join_responses(half_responses[2 * n:2 * n + 2], conf['OUTPUT_FORMAT'])
+  return responses
+
+
+def parse_detection(response: str, output_format: str = "text") -> list:
+  """
+  [(word, entity type)] of a detection response, the type is None for text responses.
+  A json response that can not be decoded (e.g. truncated) keeps the complete "text" values
+  """
+  if output_format == "json":
+    try:
+      entities = json.loads(response)
+      return [(entity["text"].strip(), entity.get("type")) for entity in entities
+              if isinstance(entity, dict) and isinstance(entity.get("text"), str)]
+    except (json.JSONDecodeError, TypeError):
+      if os.getenv("DEBUG") == "1": print(f"invalid json response: {response}")
+      values = [decode_json_string(text) for text in re.findall(r'"text"\s*:\s*"((?:[^"\\]|\\.)*)"', response)]
+      return [(value.strip(), None) for value in values if value is not None]
+  return [(item.strip(), None) for item in response.split(",")]
+
+
+def decode_json_string(text: str) -> str:
+  """
+  value of the body of a json string, None if it can not be decoded (e.g. an invalid escape)
+  """
+  try:
+    return json.loads(f'"{text}"', strict=False)
+  except json.JSONDecodeError:
+    return None
+
+
+def is_parseable(response: str, output_format: str = "text") -> bool:
+  """
+  False for responses not in the expected format (invalid json, prose instead of a list of values)
+  """
+  if output_format == "json":
+    try:
+      return isinstance(json.loads(response), list)
+    except json.JSONDecodeError:
+      return False
+  return "\n" not in response.strip() and all(len(item) <= 100 for item in response.split(","))
+
+
+def join_responses(responses: list, output_format: str = "text") -> str:
+  """
+  single detection response with the entities of several responses
+  """
+  if output_format == "json":
+    return json.dumps([{"text": text, "type": entity_type} for response in responses
+                       for text, entity_type in parse_detection(response, "json")])
+  return ", ".join(responses)
+
+
+def obfuscate(model: LLMChat, dictionary: ObfuscationDictionary, words: list, temp=1) -> list:
+  """
+  Replacements aligned with words. With a corpus dictionary only the words
+  never seen in the corpus are generated, and then stored for the next documents
+  """
+  if dictionary is None:
+    return generate_obfuscations(model, words, temp)
+  missing = dictionary.missing(words)
+  if missing:
+    dictionary.add(dict(zip(missing, generate_obfuscations(model, missing, temp))))
+  print(f"{len(missing)} new words obfuscated, {len(set(words)) - len(missing)} from the corpus dictionary")
+  return [dictionary.get(word) for word in words]
+
+
+def generate_obfuscations(model: LLMChat, words: list, temp=1) -> list:
+  """
+  Generates a replacement for every word with a single batched generate call.
+  A response equal to the input word is replaced by " "
+  """
+  if not words:
+    return []
+  responses = model.generate_response(prompt.REDACTION_INSTRUCTION_V1, prompt.EXAMPLES_ARR_REDACTION, list(words), temperature=temp)
+  obf_words = []
+  for word, response in zip(words, responses):
+    if os.getenv("DEBUG")=="1": print(response)
+    #assert word != response  # Response must be different from the input
+    if word == response:
+      response = " "
+    obf_words.append(response)
+  return obf_words
+
 
 # Helper functions
 
@@ -189,6 +645,7 @@ def redact_md(input_md_path: Path, output_md_path: Path) -> None:
   extracts text from redacted PDF and saves it in markdown format to the markdown folder path md_out/
   NOT USED
   """
+  import pymupdf4llm
   md_text = pymupdf4llm.to_markdown(input_md_path)
   output_md_path.write_bytes(md_text.encode())
 
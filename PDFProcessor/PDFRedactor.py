@@ -1,61 +1,82 @@
 import re
 import json
+import functools
 from pathlib import Path
-import PDFProcessor.pdf_redactor as pdf_redactor
 import fitz
+from PDFProcessor.WordMatcher import WordMatcher
+from PDFProcessor.PageIndex import PageIndex
+from PDFProcessor.PageParallel import split_pages, process_in_parallel
 
 class PDFRedactor:
-  def __init__(self, pdf_path: Path, words: list, obf_words: list):
+  def __init__(self, pdf_path: Path, words: list, obf_words: list, matcher: WordMatcher = None, page_index: PageIndex = None,
+               geometry: dict = None):
     self.pdf_path = pdf_path
     self.words = words
     self.obf_words = obf_words
+    self.matcher = matcher if matcher is not None else WordMatcher(words)
+    self.page_index = page_index   # the pages without any word are skipped
+    self.geometry = geometry   # word -> [[page number, [[x0, y0, x1, y1] of each line]], ...] found by the dry-run
+    self.pages_skipped = 0
+    self.page_count = None   # pages of the PDF, once redacted
 
-  def redact_words(self, output_path, metadata: str, back_color: tuple, text_color: tuple, font_size: int) -> None:
+  def redact_words(self, output_path, metadata: str, back_color: tuple, text_color: tuple, font_size: int, workers: int = 0) -> None:
     """
-    redacts the words in the PDF using PyMuPDF library
+    redacts the words in the PDF using PyMuPDF library, in page ranges on up to workers processes for long PDFs
     """
     if len(self.words) != len(self.obf_words):
       raise ValueError("The number of words to redact must match the number of replacements.")
+    if metadata not in ("clear", "redact", "keep"):
+      raise ValueError(f"Invalid value for METADATA: {metadata}")
 
     doc = fitz.open(self.pdf_path)
+    self.page_count = doc.page_count
     print(f"redacting {len(self.words)} words in {self.pdf_path}")
-        
-    # metadata redaction
-    if metadata == "clear":
-      doc.set_metadata({})  # Clear all metadata
-    elif metadata == "redact":
-      metadata = doc.metadata
-      sensitive_keys = ["author", "title", "subject", "producer", "creator"]
-      for key in sensitive_keys:
-        if key in metadata:
-          metadata[key] = "REDACTED"
-        doc.set_metadata(metadata)
-    elif metadata == "keep":
-      pass
-    else:
-      raise ValueError(f"Invalid value for METADATA: {metadata}")
 
-    patterns = [re.compile(rf"\b{re.escape(word)}\b") for word in self.words]
-
-    for page in doc:
-      text = page.get_text("text")
-      for replacement_word, pattern in zip(self.obf_words, patterns):
-        matches = list(pattern.finditer(text))
-        for match in matches:
-          areas = page.search_for(match.group())
-          for area in areas:
-            page.add_redact_annot(area, fill=back_color) 
-            rect = fitz.Rect(area)  # Get bounding rectangle
-            page.apply_redactions()  # Apply redactions first
-            text_position = fitz.Point(rect.x0, rect.y0 + (rect.height / 2) + 2)
-            page.insert_text(text_position,
-                            replacement_word,
-                            color=text_color,  # (0.243, 0.298, 0.341)
-                            fontsize=font_size,
-                            render_mode=0)
-      page.apply_redactions()
+    # the words located by the dry-run are redacted at their stored rects, the others are searched
+    stored = {}
+    if self.geometry is not None:
+      for index, word in enumerate(self.words):
+        for number, rects in self.geometry.get(word, ()):
+          stored.setdefault(number, []).append(([fitz.Rect(rect) for rect in rects], self.obf_words[index]))
+    missing = [index for index, word in enumerate(self.words) if self.geometry is None or word not in self.geometry]
+    if self.geometry is not None:
+      print(f"replaying the dry-run geometry of {len(self.words) - len(missing)} words, searching {len(missing)}")
+
+    searched, matcher = set(), None
+    if missing:
+      missing_words = [self.words[index] for index in missing]
+      matcher = self.matcher if len(missing) == len(self.words) else WordMatcher(missing_words, self.matcher.ignore_case, self.matcher.ignore_whitespace)
+      searched = set(self.page_index.pages_to_visit(doc.page_count, missing_words) if self.page_index else range(doc.page_count))
+
+    numbers = sorted(searched | set(stored))
+    self.pages_skipped = doc.page_count - len(numbers)
+    if self.pages_skipped:
+      print(f"{self.pages_skipped} of {doc.page_count} pages skipped")
+
+    workers = split_pages(doc, workers, len(numbers))
+    if workers:
+      page_count = doc.page_count
+      doc.close()
+      doc, _ = process_in_parallel(self, "redact_pages", self.pdf_path, page_count, workers, numbers,
+                                   stored, searched, matcher, missing, back_color, text_color, font_size)
+    else:
+      self.redact_pages(doc, numbers, stored, searched, matcher, missing, back_color, text_color, font_size)
+    redact_metadata(doc, metadata)
     doc.save(output_path)
 
+  def redact_pages(self, doc: fitz.Document, numbers: list, stored: dict, searched: set, matcher: WordMatcher, missing: list,
+                   back_color: tuple, text_color: tuple, font_size: int) -> None:
+    """
+    redacts the given pages: the stored rects of the page and the words of matcher (indexes missing of words) if searched
+    """
+    for number in numbers:
+      page = doc[number]
+      hits = list(stored.get(number, ()))
+      if number in searched:
+        hits += [(rects, self.obf_words[missing[index]]) for index, rects in matcher.page_hits(page)]
+      if hits:
+        redact_page(page, hits, back_color, text_color, font_size)
+
 
   # REDACTION USING PDF REDACTOR 
   def generate_filters(self) -> list:
@@ -76,6 +97,7 @@ class PDFRedactor:
     redacts the PDF using using https://github.com/JoshData/pdf-redactor 
     input: metadata_filters, text_filters, link_filters and output pdf path
     """
+    import PDFProcessor.pdf_redactor as pdf_redactor   # pdfrw is needed only by this redaction method
     options = pdf_redactor.RedactorOptions()
     options.input_stream = open(str(self.pdf_path), "rb")
     options.output_stream = open(str(output_pdf_path), "wb")
@@ -88,6 +110,49 @@ class PDFRedactor:
     pdf_redactor.redactor(options)  # Perform the redaction using PDF on standard input and writing to standard output.
 
 
+def redact_metadata(doc: fitz.Document, metadata: str) -> None:
+  """
+  clear: delete all metadata, redact: replace the sensitive fields, keep: leave them as they are
+  """
+  if metadata == "clear":
+    doc.set_metadata({})  # Clear all metadata
+  elif metadata == "redact":
+    metadata = doc.metadata
+    sensitive_keys = ["author", "title", "subject", "producer", "creator"]
+    for key in sensitive_keys:
+      if key in metadata:
+        metadata[key] = "REDACTED"
+    doc.set_metadata(metadata)
+
+
+@functools.lru_cache(maxsize=None)
+def replacement_font(name: str = "helv") -> fitz.Font:
+  """
+  font of the replacement words, loaded once per process
+  """
+  return fitz.Font(name)
+
+
+def redact_page(page: fitz.Page, hits: list, back_color: tuple, text_color: tuple, font_size: int) -> None:
+  """
+  Single pass redaction of a page, hits: [(rects of an occurrence, replacement)].
+  All the redact annotations are added first and applied once, then the replacements are written
+  with one TextWriter (applying the redactions after each hit would also erase the replacements already written).
+  An occurrence wrapped on several lines has a rect per line: all are redacted, the replacement is written once in the first
+  """
+  for rects, _ in hits:
+    for area in rects:
+      page.add_redact_annot(area, fill=back_color)
+  page.apply_redactions()
+
+  writer = fitz.TextWriter(page.rect, color=text_color)
+  font = replacement_font()
+  for rects, replacement_word in hits:
+    rect = fitz.Rect(rects[0])
+    writer.append(fitz.Point(rect.x0, rect.y0 + (rect.height / 2) + 2), replacement_word, font=font, fontsize=font_size)
+  writer.write_text(page)
+
+
 def generate_filters_json(response: str) -> list:
   """   NOT USED
   Generates a list of filters to redact words in the response (pdf-redactor format)
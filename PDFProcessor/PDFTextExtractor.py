@@ -1,32 +1,239 @@
 import os
 import re
+import functools
 from pathlib import Path
-from pdfminer.high_level import extract_text
+import fitz
+from PDFProcessor.PageIndex import PageIndex
+from PDFProcessor.PageParallel import MIN_EXTRACT_PAGES_PER_WORKER, use_workers, map_ranges
+
+SENTENCE_END = re.compile(r'(?<=[.!?]) +')
+
+# longest unfinished sentence carried over from a page to the next one
+MAX_CARRY = 100000
+
+# bump when a change of the extraction changes its text (invalidates the text cache)
+EXTRACTOR_VERSION = 1
 
 
 class PDFTextExtractor:
-    def __init__(self, pdf_path: Path):
+    def __init__(self, pdf_path: Path, engine: str = "pdfminer", page_workers: int = 0, text_cache=None, file_hash: str = None):
         self.pdf_path = pdf_path
+        self.engine = engine
+        self.page_workers = page_workers
+        self.text_cache = text_cache
+        self.file_hash = file_hash   # sha256 of the PDF if already known, else computed for the text cache key
+        self.key = None   # text cache key of the PDF
+        self.page_index = None   # token -> pages index, once all the pages are extracted
+        self.doc = None   # PyMuPDF document, left open for the highlighter
 
     def extract_text(self) -> str:
-        text = extract_text(self.pdf_path).strip().replace("\n", " ")
+        text = " ".join(self.iter_pages()).strip()
         return re.sub(r'\s{2,}', ' ', text)
 
-    def split_text_into_batches(self, text: str, max_chars=500) -> list:
-        sentences = re.split(r'(?<=[.!?]) +', text)
-        batches = []
-        current_batch = ""
-        for sentence in sentences:
-            while len(sentence) > max_chars:
-                batches.append(sentence[:max_chars].strip())
-                sentence = sentence[max_chars:]
-            if not current_batch:
-                current_batch = sentence
-            elif len(current_batch) + len(sentence) > max_chars:
-                batches.append(current_batch.strip())
-                current_batch = sentence
+    def iter_pages(self):
+        """
+        Yields the text of the PDF page by page, from the text cache if the same file was already extracted.
+        The page index of the document is read from the text cache or built from the MuPDF text of the pages:
+        along the way with the pymupdf engine, after the last page with pdfminer (whose text may differ
+        in spacing, merged words or unmapped CID fonts from the text searched by the highlight and the redaction)
+        """
+        index = None
+        if self.text_cache is None:
+            pages = self.extract_pages()
+        else:
+            self.key = self.cache_key()
+            index = self.text_cache.get_index(self.key)
+            cached = self.text_cache.get(self.key)
+            if cached is not None:
+                if os.getenv("DEBUG") == "1": print(f"text of {self.pdf_path} from the text cache")
+                pages = cached
+            else:
+                pages = self.text_cache.put(self.key, self.extract_pages())
+        if index is not None:
+            yield from pages
+            self.page_index = index
+            return
+
+        index = PageIndex()
+        if self.engine == "pymupdf":
+            for number, page in enumerate(pages):
+                index.add(number, page)
+                yield page
+        else:
+            yield from pages
+            with fitz.open(self.pdf_path) as doc:
+                for number, page in enumerate(doc):
+                    index.add(number, page.get_text())
+        self.page_index = index
+        if self.text_cache is not None:
+            self.text_cache.put_index(self.key, index)
+
+    def cache_key(self) -> str:
+        if self.file_hash is None:
+            self.file_hash = self.text_cache.file_hash(self.pdf_path)
+        return f"{self.file_hash}-{self.version()}"
+
+    def version(self) -> str:
+        """
+        engine, library version and EXTRACTOR_VERSION: what determines the extracted text
+        """
+        if self.engine == "pdfminer":
+            import pdfminer
+            return f"pdfminer{pdfminer.__version__}-v{EXTRACTOR_VERSION}"
+        return f"pymupdf{fitz.VersionBind}-v{EXTRACTOR_VERSION}"
+
+    def extract_pages(self):
+        if self.engine == "pdfminer":
+            from pdfminer.high_level import extract_pages   # only the dry-run needs pdfminer
+            from pdfminer.layout import LTTextContainer
+            for page in extract_pages(self.pdf_path):
+                yield "".join(element.get_text() for element in page if isinstance(element, LTTextContainer)).replace("\n", " ")
+        elif self.engine == "pymupdf":
+            self.doc = fitz.open(self.pdf_path)
+            workers = use_workers(self.page_workers, self.doc.page_count, MIN_EXTRACT_PAGES_PER_WORKER)
+            if workers:
+                yield from self.iter_pages_parallel(workers)
             else:
-                current_batch += " " + sentence
-        if current_batch:
-            batches.append(current_batch.strip())
-        return batches
+                for page in self.doc:
+                    yield page.get_text().replace("\n", " ")
+        else:
+            raise ValueError(f"Invalid EXTRACTION_ENGINE: {self.engine}, please choose between 'pdfminer' and 'pymupdf'")
+
+    def iter_pages_parallel(self, workers: int):
+        """
+        Splits the pages in workers ranges extracted by worker processes, yields them in page order
+        """
+        for pages in map_ranges(extract_page_range, self.pdf_path, self.doc.page_count, workers):
+            yield from pages
+
+    def split_text_into_batches(self, text: str, max_chars=500) -> list:
+        return list(iter_batches(SENTENCE_END.split(text), max_chars))
+
+    def split_text_into_token_batches(self, text: str, count_tokens, max_tokens: int) -> list:
+        """
+        Packs whole sentences into batches of at most max_tokens tokens (count_tokens: str -> int).
+        Sentences longer than the budget are split between words.
+        """
+        return list(iter_token_batches(SENTENCE_END.split(text), count_tokens, max_tokens))
+
+
+def iter_sentences(pages):
+    """
+    Yields the sentences of a stream of page texts, with the whitespace normalized as in extract_text.
+    Only the unfinished sentence at the end of a page is carried over to the next one
+    """
+    carry = ""
+    for page in pages:
+        buffer = re.sub(r'\s{2,}', ' ', carry + " " + page if carry else page.lstrip())
+        sentences = SENTENCE_END.split(buffer)
+        carry = sentences.pop()
+        if len(carry) > MAX_CARRY:   # no sentence end in sight (e.g. OCR noise), don't keep growing
+            sentences.append(carry)
+            carry = ""
+        yield from sentences
+    carry = carry.rstrip()
+    if carry:
+        yield carry
+
+
+def iter_batches(sentences, max_chars: int = 500):
+    """
+    Packs the sentences into batches of at most max_chars characters,
+    sentences longer than max_chars are cut every max_chars characters
+    """
+    current_batch = ""
+    for sentence in sentences:
+        start = 0
+        while len(sentence) - start > max_chars:
+            yield sentence[start:start + max_chars].strip()
+            start += max_chars
+        if start:
+            sentence = sentence[start:]
+        if not current_batch:
+            current_batch = sentence
+        elif len(current_batch) + len(sentence) > max_chars:
+            yield current_batch.strip()
+            current_batch = sentence
+        else:
+            current_batch += " " + sentence
+    if current_batch:
+        yield current_batch.strip()
+
+
+def iter_token_batches(sentences, count_tokens, max_tokens: int):
+    """
+    Packs the sentences into batches of at most max_tokens tokens, see split_text_into_token_batches
+    """
+    current_batch = []
+    current_tokens = 0
+    for sentence in sentences:
+        tokens = count_tokens(sentence) + 1   # + separator
+        if tokens > max_tokens:
+            pieces = split_by_tokens(sentence, count_tokens, max_tokens)
+        else:
+            pieces = [(sentence, tokens)]
+        for piece, piece_tokens in pieces:
+            if current_batch and current_tokens + piece_tokens > max_tokens:
+                batch = " ".join(current_batch).strip()
+                if batch:
+                    yield batch
+                current_batch, current_tokens = [], 0
+            current_batch.append(piece)
+            current_tokens += piece_tokens
+    if current_batch:
+        batch = " ".join(current_batch).strip()
+        if batch:
+            yield batch
+
+
+def extract_page_range(pdf_path: str, start: int, stop: int) -> list:
+    """
+    Text of the pages start..stop-1 of the PDF (runs in a worker process)
+    """
+    with fitz.open(pdf_path) as doc:
+        return [doc[number].get_text().replace("\n", " ") for number in range(start, stop)]
+
+
+def split_by_tokens(sentence: str, count_tokens, max_tokens: int) -> list:
+    """
+    Splits a long sentence between words into pieces of at most max_tokens tokens, returns [(piece, tokens)]
+    """
+    pieces = []
+    current, current_tokens = [], 0
+    for word in sentence.split(" "):
+        tokens = count_tokens(" " + word)
+        if current and current_tokens + tokens > max_tokens:
+            pieces.append((" ".join(current), current_tokens))
+            current, current_tokens = [], 0
+        current.append(word)
+        current_tokens += tokens
+    if current:
+        pieces.append((" ".join(current), current_tokens))
+    return pieces
+
+
+def split_in_half(text: str) -> list:
+    """
+    Splits a batch in two halves at a sentence (or word) boundary, used to re-run truncated responses.
+    Returns [text] if it can not be split
+    """
+    parts = SENTENCE_END.split(text)
+    if len(parts) < 2:
+        parts = text.split(" ")
+    if len(parts) < 2:
+        return [text]
+    middle = len(parts) // 2
+    return [" ".join(parts[:middle]), " ".join(parts[middle:])]
+
+
+@functools.lru_cache(maxsize=None)
+def load_token_counter(tokenizer_name: str = None):
+    """
+    Token counter (str -> int) of the model tokenizer, loaded once per process.
+    Without a tokenizer the count is estimated as 4 characters per token
+    """
+    if tokenizer_name is None:
+        return lambda text: len(text) // 4 + 1
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
@@ -0,0 +1,156 @@
+import re
+from datetime import datetime
+
+MONTHS = "January|February|March|April|May|June|July|August|September|October|November|December"
+
+# All the detectors in a single alternation, the text is scanned once.
+# Every named group is validated by the function of the same name in VALIDATORS,
+# when the validation fails the following detectors are tried at the same position (GROUPS)
+DETECTORS = [
+  ("EMAIL", r"\b[\w.+-]+@[\w-]+(?:\.[\w-]+)*\.[A-Za-z]{2,}\b"),
+  ("IBAN", r"\b[A-Z]{2}\d{2}(?:[ ]?[A-Z0-9]){11,30}\b"),
+  ("CARD", r"\b\d(?:[ -]?\d){12,18}\b"),
+  ("SSN", r"\b\d{3}-\d{2}-\d{4}\b"),
+  ("DATE_ISO", r"\b\d{4}-\d{2}-\d{2}\b"),
+  ("DATE_LONG", rf"\b\d{{1,2}} (?:{MONTHS}) \d{{4}}\b|\b(?:{MONTHS}) \d{{1,2}}, \d{{4}}\b"),
+  ("PHONE", r"(?:(?:\+|\b00)\d{1,3}[ .-]?)?(?:\(\d{2,4}\)[ .-]?|\b\d{2,4}[ .-])\d{3,4}[ .-]?\d{3,4}\b"),
+]
+PATTERN = re.compile("|".join(f"(?P<{name}>{regex})" for name, regex in DETECTORS))
+GROUPS = [(name, re.compile(regex)) for name, regex in DETECTORS]
+ORDER = {name: idx for idx, (name, _) in enumerate(DETECTORS)}
+
+# entity type of the detections (same names of the LLM json output)
+ENTITY_TYPES = {"EMAIL": "EMAIL", "IBAN": "FINANCIAL", "CARD": "FINANCIAL", "SSN": "ID_NUMBER",
+                "DATE_ISO": "DATE", "DATE_LONG": "DATE", "PHONE": "PHONE"}
+
+PLACEHOLDER = re.compile(r"^\[(?:%s)\]$" % "|".join(sorted(set(ENTITY_TYPES.values()))))
+
+
+def luhn(number: str) -> bool:
+  digits = [int(char) for char in number if char.isdigit()]
+  checksum = 0
+  for idx, digit in enumerate(reversed(digits)):
+    if idx % 2 == 1:
+      digit = digit * 2 - 9 if digit > 4 else digit * 2
+    checksum += digit
+  return checksum % 10 == 0
+
+
+def iban_length(value: str) -> int:
+  """
+  length (in characters of value) of the longest valid IBAN at the start of value, 0 if none (ISO 13616 mod 97)
+  """
+  compact = value.replace(" ", "")
+  for length in range(min(len(compact), 34), 14, -1):
+    candidate = compact[4:length] + compact[:4]
+    if int("".join(str(int(char, 36)) for char in candidate)) % 97 == 1:
+      # map the compact length back to the spaced value
+      seen = 0
+      for idx, char in enumerate(value):
+        seen += char != " "
+        if seen == length:
+          return idx + 1
+  return 0
+
+
+def valid_ssn(value: str) -> bool:
+  area, group, serial = value.split("-")
+  return area not in ("000", "666") and area[0] != "9" and group != "00" and serial != "0000"
+
+
+def valid_date(value: str, formats: tuple) -> bool:
+  for date_format in formats:
+    try:
+      datetime.strptime(value, date_format)
+      return True
+    except ValueError:
+      pass
+  return False
+
+
+def valid_phone(value: str) -> bool:
+  """
+  9 to 15 digits with the shape of a phone number: an international prefix (+ or 00), an area code in parentheses,
+  a national trunk prefix (leading 0) or the 3-3-4 groups of North America, with a single kind of separator.
+  Amounts, years and other runs of numbers (e.g. 125.250.000, 2019 2020 2021) are left to the LLM
+  """
+  if not 9 <= sum(char.isdigit() for char in value) <= 15:
+    return False
+  if value.startswith(("+", "00", "(")):
+    return True
+  separators = set(re.findall(r"[ .-]", value))
+  groups = re.split(r"[ .-]", value)
+  if len(separators) > 1:
+    return False
+  if separators == {"."} and all(len(group) == 3 for group in groups[1:]):   # thousands separators
+    return False
+  return value.startswith("0") or [len(group) for group in groups] == [3, 3, 4]
+
+
+VALIDATORS = {
+  "EMAIL": lambda value: True,
+  "CARD": lambda value: len(re.sub(r"\D", "", value)) >= 13 and luhn(value),
+  "SSN": valid_ssn,
+  "DATE_ISO": lambda value: valid_date(value, ("%Y-%m-%d",)),
+  "DATE_LONG": lambda value: valid_date(value, ("%d %B %Y", "%B %d, %Y")),
+  "PHONE": valid_phone,
+}
+
+
+def validate(name: str, value: str) -> str:
+  """
+  the validated value of a detection (an IBAN is cut to its valid length), None if not valid
+  """
+  if name == "IBAN":
+    length = iban_length(value)
+    return value[:length] if length else None
+  return value if VALIDATORS[name](value) else None
+
+
+class PIIDetector:
+  """
+  Deterministic detectors of structured sensitive data (emails, phones, IBANs, credit cards, SSNs, dates)
+  validated with checksums/calendars, run before the LLM so the model only spends tokens on free-form entities
+  """
+  def detect(self, text: str) -> list:
+    """
+    returns the validated hits [(start, end, value, entity type)] in a single pass over the text
+    """
+    hits = []
+    position = 0
+    while True:
+      match = PATTERN.search(text, position)
+      if match is None:
+        return hits
+      start, name = match.start(), match.lastgroup
+      value = validate(name, match.group())
+      if value is None:
+        # the following detectors at the same position, e.g. a phone number that is not a valid card
+        for name, regex in GROUPS[ORDER[name] + 1:]:
+          retry = regex.match(text, start)
+          value = validate(name, retry.group()) if retry else None
+          if value is not None:
+            break
+      if value is None:
+        position = start + 1
+        continue
+      hits.append((start, start + len(value), value, ENTITY_TYPES[name]))
+      position = start + len(value)
+
+  def mask(self, text: str, hits: list) -> str:
+    """
+    replaces the hits with a placeholder of their type, e.g. [EMAIL]
+    """
+    pieces = []
+    last = 0
+    for start, end, _, entity_type in hits:
+      pieces.append(text[last:start])
+      pieces.append(f"[{entity_type}]")
+      last = end
+    pieces.append(text[last:])
+    return "".join(pieces)
+
+
+def is_placeholder(word: str) -> bool:
+  """ the LLM may repeat the placeholders of the masked text """
+  return bool(PLACEHOLDER.match(word))
@@ -0,0 +1,68 @@
+import re
+import json
+import zlib
+
+# bump when a change of the tokens invalidates the stored indexes
+INDEX_VERSION = 3
+
+# a word hyphenated at the end of a line
+HYPHENATION = re.compile(r"(\w)-\s+(\w)")
+
+
+def tokenize(text: str) -> list:
+  """
+  word tokens, folded like the case-insensitive matcher so that the index is a superset of what it can find
+  """
+  return re.findall(r"\w+", "".join(char.lower()[:1] or char for char in text))
+
+
+class PageIndex:
+  """
+  Inverted index token -> pages of a document, built from the MuPDF text of the pages (the text the matcher searches,
+  whatever the extraction engine). A page can contain a word only if it contains all the tokens of the word,
+  the other pages are skipped by the highlight and the redaction.
+  """
+  def __init__(self, tokens: dict = None, page_count: int = 0):
+    self.tokens = tokens if tokens is not None else {}
+    self.page_count = page_count
+
+  def add(self, page_number: int, text: str) -> None:
+    """
+    tokens of the text of a page, also with the words hyphenated at the end of a line joined (as the matcher does)
+    """
+    for token in set(tokenize(text)) | set(tokenize(HYPHENATION.sub(r"\1\2", text))):
+      self.tokens.setdefault(token, set()).add(page_number)
+    self.page_count = max(self.page_count, page_number + 1)
+
+  def candidates(self, words: list) -> set:
+    """
+    Pages that may contain one of the words, None if the index can't tell (all the pages)
+    """
+    pages = set()
+    for word in words:
+      tokens = tokenize(word)
+      if not tokens:
+        return None
+      word_pages = set(self.tokens.get(tokens[0], ()))
+      for token in tokens[1:]:
+        word_pages &= self.tokens.get(token, set())
+      pages |= word_pages
+    return pages
+
+  def pages_to_visit(self, page_count: int, words: list) -> list:
+    """
+    Numbers of the pages that may contain the words, all the pages if the index is not of this document
+    """
+    pages = self.candidates(words) if page_count == self.page_count else None
+    return list(range(page_count)) if pages is None else sorted(pages)
+
+  def dumps(self) -> bytes:
+    payload = {"version": INDEX_VERSION, "page_count": self.page_count, "tokens": {token: sorted(pages) for token, pages in self.tokens.items()}}
+    return zlib.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+
+  @classmethod
+  def loads(cls, data: bytes) -> "PageIndex":
+    payload = json.loads(zlib.decompress(data).decode("utf-8"))
+    if payload.get("version") != INDEX_VERSION:
+      raise ValueError(f"page index version {payload.get('version')}, expected {INDEX_VERSION}")
+    return cls({token: set(pages) for token, pages in payload["tokens"].items()}, payload["page_count"])
@@ -0,0 +1,90 @@
+import os
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import fitz
+
+# below this many pages per worker the process start-up costs more than it saves
+MIN_PAGES_PER_WORKER = 50
+# the text extraction of a page is much cheaper than its highlight or redaction
+MIN_EXTRACT_PAGES_PER_WORKER = 1000
+
+
+def use_workers(workers: int, pages: int, min_pages: int = MIN_PAGES_PER_WORKER) -> int:
+  """
+  number of processes worth using for pages pages (0 = process them in the current one)
+  """
+  workers = min(workers, pages // min_pages)
+  return workers if workers > 1 else 0
+
+
+def page_ranges(page_count: int, workers: int) -> list:
+  """
+  [(start, stop)] splitting the pages in at most workers ranges
+  """
+  step = -(-page_count // workers)
+  return [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+
+
+def map_ranges(function, pdf_path, page_count: int, workers: int, *args):
+  """
+  Runs function(pdf_path, start, stop, *args) on every page range in a separate process,
+  yields the results in page order
+  """
+  context = multiprocessing.get_context("spawn")   # never fork a process holding the CUDA context
+  with ProcessPoolExecutor(workers, mp_context=context) as pool:
+    futures = [pool.submit(function, str(pdf_path), start, stop, *args) for start, stop in page_ranges(page_count, workers)]
+    for future in futures:
+      yield future.result()
+
+
+def process_range(pdf_path: str, start: int, stop: int, processor, method: str, folder: str, numbers: list, args: tuple):
+  """
+  Worker: opens the PDF, runs processor.method(doc, numbers of the range, *args) and saves the pages start..stop-1.
+  Returns the result and the links to pages out of the range, which the saved part can't keep.
+  """
+  with fitz.open(pdf_path) as doc:
+    result = getattr(processor, method)(doc, [number for number in numbers if start <= number < stop], *args)
+    links = [(number, link) for number in range(start, stop) for link in doc[number].get_links()
+             if link["kind"] == fitz.LINK_GOTO and not start <= link["page"] < stop]
+    with fitz.open() as part:
+      part.insert_pdf(doc, from_page=start, to_page=stop - 1)
+      part.save(os.path.join(folder, f"{start}.pdf"), garbage=1)
+  return result, links
+
+
+def process_in_parallel(processor, method: str, pdf_path, page_count: int, workers: int, numbers: list, *args) -> tuple:
+  """
+  Splits the pages of the PDF in workers ranges processed by processor.method in separate processes,
+  each opening the PDF on its own. Returns the document merged from the ranges and the results of the
+  ranges in page order.
+  The merged document gets back the metadata, the outline, the page labels and the links between ranges
+  of the source; the rest of the document catalog (form fields, named destinations, attachments,
+  optional content) is not carried over, PDFs with form fields are never split (see split_pages).
+  """
+  with tempfile.TemporaryDirectory() as folder:
+    results, links = [], []
+    for result, range_links in map_ranges(process_range, pdf_path, page_count, workers, processor, method, folder, numbers, args):
+      results.append(result)
+      links.extend(range_links)
+
+    merged = fitz.open()
+    for start, _ in page_ranges(page_count, workers):
+      with fitz.open(os.path.join(folder, f"{start}.pdf")) as part:
+        merged.insert_pdf(part)
+  for number, link in links:
+    merged[number].insert_link(link)
+  with fitz.open(pdf_path) as source:
+    merged.set_metadata(source.metadata)
+    merged.set_toc(source.get_toc(simple=False))
+    labels = source.get_page_labels()
+    if labels:
+      merged.set_page_labels(labels)
+  return merged, results
+
+
+def split_pages(doc, workers: int, pages: int) -> int:
+  """
+  use_workers for the pages of an open document: 0 if it has form fields, which the merge would lose
+  """
+  return 0 if doc.is_form_pdf else use_workers(workers, pages)
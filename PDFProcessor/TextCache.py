@@ -0,0 +1,90 @@
+import os
+import mmap
+import zlib
+import struct
+import hashlib
+from pathlib import Path
+from PDFProcessor.PageIndex import PageIndex
+
+MAGIC = b"ATXT"
+HEADER = struct.Struct("<4sI")   # magic, number of pages
+OFFSET = struct.Struct("<Q")     # end offset of a page in the file
+
+
+class TextCache:
+  """
+  Extracted text of the PDFs, keyed by the sha256 of the file content and the extractor version.
+
+  An entry is one file: header, end offsets of the pages and the zlib-compressed pages,
+  read back page by page through mmap. The page index of the PDF is stored next to it (.idx).
+  Files are written to a temporary file and renamed, so concurrent processes never read a partial entry.
+  """
+  def __init__(self, folder: Path):
+    self.folder = Path(folder)
+    self.folder.mkdir(parents=True, exist_ok=True)
+
+  @staticmethod
+  def file_hash(pdf_path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+      for block in iter(lambda: f.read(1 << 20), b""):
+        digest.update(block)
+    return digest.hexdigest()
+
+  def entry(self, key: str) -> Path:
+    return self.folder / f"{key}.txtz"
+
+  def get_index(self, key: str) -> PageIndex:
+    try:
+      return PageIndex.loads(self.entry(key).with_suffix(".idx").read_bytes())
+    except (FileNotFoundError, ValueError):   # missing or of an older version
+      return None
+
+  def put_index(self, key: str, index: PageIndex) -> None:
+    path = self.entry(key).with_suffix(".idx")
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_bytes(index.dumps())
+    os.replace(tmp_path, path)
+
+  def get(self, key: str):
+    """
+    Iterator over the cached pages of key, None on a miss
+    """
+    path = self.entry(key)
+    try:
+      with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+          return None
+    except FileNotFoundError:
+      return None
+    return self.read(path)
+
+  def read(self, path: Path):
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      _, count = HEADER.unpack_from(data, 0)
+      start = HEADER.size + count * OFFSET.size
+      for number in range(count):
+        end, = OFFSET.unpack_from(data, HEADER.size + number * OFFSET.size)
+        yield zlib.decompress(data[start:end]).decode("utf-8")
+        start = end
+
+  def put(self, key: str, pages):
+    """
+    Passes the pages through while compressing them, the entry is written when the iteration completes
+    """
+    blobs = []
+    for page in pages:
+      blobs.append(zlib.compress(page.encode("utf-8")))
+      yield page
+
+    path = self.entry(key)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    end = HEADER.size + len(blobs) * OFFSET.size
+    with open(tmp_path, "wb") as f:
+      f.write(HEADER.pack(MAGIC, len(blobs)))
+      for blob in blobs:
+        end += len(blob)
+        f.write(OFFSET.pack(end))
+      for blob in blobs:
+        f.write(blob)
+    os.replace(tmp_path, path)
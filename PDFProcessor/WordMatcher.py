@@ -0,0 +1,156 @@
+from collections import deque
+import fitz
+
+# text of a page for matching: characters with their bbox, no images
+PAGE_TEXT_FLAGS = fitz.TEXTFLAGS_RAWDICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+
+def is_word_char(char: str) -> bool:
+  return char.isalnum() or char == "_"
+
+
+class WordMatcher:
+  """
+  Aho-Corasick automaton of the words to highlight or redact, built once per document:
+  one pass over the text of a page finds the occurrences of every word.
+
+  Matches are whole words (not glued to a letter or digit on a side where the word starts or ends with one),
+  overlapping matches are resolved leftmost-longest. With ignore_case the matching is case-insensitive,
+  with ignore_whitespace any run of whitespace (including line breaks) matches a space.
+  """
+  def __init__(self, words: list, ignore_case: bool = True, ignore_whitespace: bool = True):
+    self.words = list(words)
+    self.ignore_case = ignore_case
+    self.ignore_whitespace = ignore_whitespace
+    self.goto = [{}]
+    self.fail = [0]
+    self.out = [[]]   # (length, word index) of the words ending in each state
+    for index, word in enumerate(self.words):
+      self.add(self.normalize(word), index)
+    self.link()
+
+  def fold(self, char: str) -> str:
+    return char.lower()[:1] or char if self.ignore_case else char
+
+  def normalize(self, word: str) -> str:
+    if self.ignore_whitespace:
+      word = " ".join(word.split())
+    return "".join(self.fold(char) for char in word)
+
+  def add(self, key: str, index: int) -> None:
+    if not key:
+      return
+    state = 0
+    for char in key:
+      following = self.goto[state].get(char)
+      if following is None:
+        following = len(self.goto)
+        self.goto[state][char] = following
+        self.goto.append({})
+        self.fail.append(0)
+        self.out.append([])
+      state = following
+    if not self.out[state]:   # the same key twice (e.g. differing only in case) keeps the first word
+      self.out[state].append((len(key), index))
+
+  def link(self) -> None:
+    """
+    failure links, breadth first
+    """
+    states = deque(self.goto[0].values())
+    while states:
+      state = states.popleft()
+      for char, child in self.goto[state].items():
+        states.append(child)
+        fallback = self.fail[state]
+        while fallback and char not in self.goto[fallback]:
+          fallback = self.fail[fallback]
+        self.fail[child] = self.goto[fallback].get(char, 0)
+        self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+  def find(self, text: str) -> list:
+    """
+    [(start, end, word index)] of the whole-word occurrences in text, without overlaps
+    """
+    state, matches = 0, []
+    for position, char in enumerate(text):
+      char = self.fold(char)
+      while state and char not in self.goto[state]:
+        state = self.fail[state]
+      state = self.goto[state].get(char, 0)
+      for length, index in self.out[state]:
+        start, end = position + 1 - length, position + 1
+        if self.bounded(text, start, end):
+          matches.append((start, end, index))
+
+    matches.sort(key=lambda match: (match[0], -match[1]))
+    selected, end = [], 0
+    for match in matches:
+      if match[0] >= end:
+        selected.append(match)
+        end = match[1]
+    return selected
+
+  @staticmethod
+  def bounded(text: str, start: int, end: int) -> bool:
+    if start > 0 and is_word_char(text[start - 1]) and is_word_char(text[start]):
+      return False
+    if end < len(text) and is_word_char(text[end - 1]) and is_word_char(text[end]):
+      return False
+    return True
+
+  def page_text(self, page: fitz.Page) -> tuple:
+    """
+    Text of the page (lines joined by a space) and the (line number, bbox) of each of its characters.
+    A line ending with a hyphen after a letter is joined to the next one without a space, like the dehyphenation
+    of search_for: the hyphen is dropped when the next line starts with a lowercase letter ("Spring-" "field"
+    -> "Springfield", its box is merged into the previous character), kept otherwise ("Jean-" "Paul" -> "Jean-Paul")
+    """
+    chars, boxes = [], []
+    line_number = 0
+    for block in page.get_text("rawdict", flags=PAGE_TEXT_FLAGS)["blocks"]:
+      for line in block.get("lines", ()):
+        line_number += 1
+        end = len(chars)
+        while end and chars[end - 1] == " " and boxes[end - 1] is not None:   # trailing spaces of the previous line
+          end -= 1
+        hyphen = end > 1 and chars[end - 1] == "-" and chars[end - 2].isalpha()
+        if hyphen:
+          del chars[end:], boxes[end:]
+        elif chars and not (self.ignore_whitespace and chars[-1] == " "):
+          chars.append(" ")
+          boxes.append(None)
+        for span in line["spans"]:
+          for char in span["chars"]:
+            c = char["c"]
+            if hyphen:
+              hyphen = False
+              if c.islower():
+                line_box, bbox = boxes[-2]
+                boxes[-2] = (line_box, fitz.Rect(bbox) | boxes[-1][1])
+                chars.pop()
+                boxes.pop()
+            if self.ignore_whitespace and c.isspace():
+              if chars and chars[-1] == " ":
+                continue
+              c = " "
+            chars.append(c)
+            boxes.append((line_number, char["bbox"]))
+    return "".join(chars), boxes
+
+  def page_hits(self, page: fitz.Page) -> list:
+    """
+    [(word index, [rect of each line of the occurrence])] of the words on the page
+    """
+    if not self.words:
+      return []
+    text, boxes = self.page_text(page)
+    hits = []
+    for start, end, index in self.find(text):
+      rects = {}
+      for box in boxes[start:end]:
+        if box is not None:
+          line_number, bbox = box
+          rects[line_number] = rects[line_number] | bbox if line_number in rects else fitz.Rect(bbox)
+      hits.append((index, list(rects.values())))
+    return hits
@@ -0,0 +1,185 @@
+import argparse
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# modules that only the dry-run (or optional features) may load
+HEAVY_MODULES = ("vllm", "torch", "transformers", "pdfminer", "pymupdf4llm", "pdfrw", "aiohttp")
+
+
+def bench_imports(args) -> bool:
+  """
+  Import time of main.py in a fresh interpreter (what every redaction run pays before doing any work)
+  and check that no heavy dependency is loaded at import
+  """
+  code = ("import sys, time; start = time.perf_counter(); import main; elapsed = time.perf_counter() - start; "
+          f"print(elapsed, ','.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))")
+  timings, heavy = [], ""
+  for _ in range(args.repeat):
+    elapsed, _, heavy = subprocess.check_output([sys.executable, "-c", code], text=True).strip().partition(" ")
+    timings.append(float(elapsed))
+  best = min(timings)
+  print(f"import main: {best:.3f}s (best of {args.repeat}), budget {args.budget:.3f}s")
+  if heavy:
+    print(f"heavy modules loaded at import: {heavy}")
+  return best <= args.budget and not heavy
+
+
+def pdf_files(path: Path) -> list:
+  return sorted(path.glob("*.pdf")) if path.is_dir() else [path]
+
+
+def bench_extract(args) -> bool:
+  """
+  Text extraction time of the PDFs with pdfminer, pymupdf and pymupdf over parallel page ranges
+  """
+  from PDFProcessor.PDFTextExtractor import PDFTextExtractor
+  pdfs = pdf_files(args.pdf)
+  engines = [("pdfminer", 0), ("pymupdf", 0)]
+  if args.page_workers > 1:
+    engines.append(("pymupdf", args.page_workers))
+  timings = {}
+  for engine, workers in engines:
+    best, chars = float("inf"), 0
+    for _ in range(args.repeat):
+      start = time.perf_counter()
+      chars = sum(len(PDFTextExtractor(pdf, engine, workers).extract_text()) for pdf in pdfs)
+      best = min(best, time.perf_counter() - start)
+    timings[(engine, workers)] = best
+    label = f"{engine} ({workers} page workers)" if workers else engine
+    print(f"{label:<30} {best:8.3f}s  {chars} chars from {len(pdfs)} PDFs")
+  speedup = timings[("pdfminer", 0)] / timings[("pymupdf", 0)]
+  print(f"pymupdf speedup: {speedup:.1f}x (required {args.min_speedup:.1f}x)")
+  return speedup >= args.min_speedup
+
+
+def synthetic_pdf(path: Path, pages: int, hits_per_page: int, word: str = "Johnson") -> None:
+  """
+  PDF of pages of 50 lines of filler text with hits_per_page occurrences of word
+  """
+  import fitz
+  doc = fitz.open()
+  for _ in range(pages):
+    page = doc.new_page()
+    for line in range(50):
+      hits = hits_per_page // 50 + (line < hits_per_page % 50)
+      text = " ".join(["lorem ipsum dolor sit amet"] + [f"{word} consectetur"] * hits)
+      page.insert_text((40, 40 + line * 14), text, fontsize=8)
+  doc.save(path)
+
+
+def redact_per_hit(pdf_path: Path, output_path: Path, word: str, replacement: str) -> None:
+  """
+  reference: redactions applied and replacement written after every hit
+  """
+  import fitz
+  doc = fitz.open(pdf_path)
+  for page in doc:
+    for area in page.search_for(word):
+      page.add_redact_annot(area, fill=(1, 1, 1))
+      page.apply_redactions()
+      page.insert_text(fitz.Point(area.x0, area.y0 + area.height / 2 + 2), replacement, fontsize=7)
+  doc.save(output_path)
+
+
+def bench_redact(args) -> bool:
+  """
+  Redaction time per page and apply_redactions calls per page as the hits per page grow,
+  single pass engine vs the per-hit reference
+  """
+  import tempfile
+  import fitz
+  from PDFProcessor.PDFRedactor import PDFRedactor
+  applied = [0]
+  apply_redactions = fitz.Page.apply_redactions
+  def counted(page, *a, **kw):
+    applied[0] += 1
+    return apply_redactions(page, *a, **kw)
+
+  speedup = 0.0
+  with tempfile.TemporaryDirectory() as folder:
+    folder = Path(folder)
+    fitz.Page.apply_redactions = counted
+    try:
+      for hits in args.hits:
+        pdf_path = folder / f"hits{hits}.pdf"
+        synthetic_pdf(pdf_path, args.pages, hits)
+        applied[0] = 0
+        start = time.perf_counter()
+        PDFRedactor(pdf_path, ["Johnson"], ["Smith"]).redact_words(folder / "out.pdf", "keep", (1, 1, 1), (0, 0, 0), 7)
+        single, single_applied = (time.perf_counter() - start) / args.pages, applied[0] / args.pages
+        applied[0] = 0
+        start = time.perf_counter()
+        redact_per_hit(pdf_path, folder / "ref.pdf", "Johnson", "Smith")
+        reference, reference_applied = (time.perf_counter() - start) / args.pages, applied[0] / args.pages
+        speedup = reference / single
+        print(f"{hits:>5} hits/page: single pass {single * 1000:8.2f} ms/page ({single_applied:.0f} apply/page), "
+              f"per-hit apply {reference * 1000:8.2f} ms/page ({reference_applied:.0f} apply/page)")
+    finally:
+      fitz.Page.apply_redactions = apply_redactions
+  print(f"speedup at {args.hits[-1]} hits/page: {speedup:.1f}x (required {args.min_speedup:.1f}x)")
+  return single_applied == 1 and speedup >= args.min_speedup
+
+
+def bench_pages(args) -> bool:
+  """
+  Highlight and redaction time of a long PDF on one process and on --workers processes (page ranges)
+  """
+  import os
+  import tempfile
+  from PDFProcessor.PDFHighlighter import PDFHighlighter
+  from PDFProcessor.PDFRedactor import PDFRedactor
+  if os.cpu_count() < args.workers:
+    print(f"only {os.cpu_count()} CPUs for {args.workers} workers, expect no speedup")
+  speedups = []
+  with tempfile.TemporaryDirectory() as folder:
+    folder = Path(folder)
+    pdf_path = folder / "long.pdf"
+    synthetic_pdf(pdf_path, args.pages, args.hits)
+    for stage in ("highlight", "redact"):
+      timings = []
+      for workers in (0, args.workers):
+        start = time.perf_counter()
+        if stage == "highlight":
+          PDFHighlighter(pdf_path, ["Johnson"], ["Smith"]).highlight(folder / "out.pdf", workers=workers)
+        else:
+          PDFRedactor(pdf_path, ["Johnson"], ["Smith"]).redact_words(folder / "out.pdf", "keep", (1, 1, 1), (0, 0, 0), 7, workers=workers)
+        timings.append(time.perf_counter() - start)
+      speedups.append(timings[0] / timings[1])
+      print(f"{stage:<10} {args.pages} pages: 1 process {timings[0]:7.2f}s, {args.workers} workers {timings[1]:7.2f}s, speedup {speedups[-1]:.1f}x")
+  print(f"required speedup {args.min_speedup:.1f}x")
+  return min(speedups) >= args.min_speedup
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="AnonyMate benchmarks", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+  imports = subparsers.add_parser("imports", help="import-time budget of main.py")
+  imports.add_argument("--budget", type=float, default=0.5, help="Max seconds to import main.py")
+  imports.add_argument("--repeat", type=int, default=5, help="Fresh interpreters to time")
+  imports.set_defaults(run=bench_imports)
+
+  extract = subparsers.add_parser("extract", help="text extraction time of pdfminer vs pymupdf")
+  extract.add_argument("--pdf", type=Path, default=Path("pdf_in"), help="PDF or folder of PDFs")
+  extract.add_argument("--page-workers", type=int, default=0, help="Also time pymupdf with this many page range processes")
+  extract.add_argument("--repeat", type=int, default=3, help="Runs per engine (best is kept)")
+  extract.add_argument("--min-speedup", type=float, default=1.0, help="Min speedup of pymupdf over pdfminer")
+  extract.set_defaults(run=bench_extract)
+
+  redact = subparsers.add_parser("redact", help="redaction cost per page vs hits per page")
+  redact.add_argument("--pages", type=int, default=20, help="Pages of the synthetic PDFs")
+  redact.add_argument("--hits", type=int, nargs="+", default=[1, 10, 100], help="Hits per page of the synthetic PDFs")
+  redact.add_argument("--min-speedup", type=float, default=1.5, help="Min speedup over the per-hit reference at the last --hits")
+  redact.set_defaults(run=bench_redact)
+
+  pages = subparsers.add_parser("pages", help="page-parallel highlight and redaction speedup")
+  pages.add_argument("--pages", type=int, default=1000, help="Pages of the synthetic PDF")
+  pages.add_argument("--hits", type=int, default=10, help="Hits per page of the synthetic PDF")
+  pages.add_argument("--workers", type=int, default=4, help="Page workers")
+  pages.add_argument("--min-speedup", type=float, default=1.5, help="Min speedup of both stages")
+  pages.set_defaults(run=bench_pages)
+
+  args = parser.parse_args()
+  sys.exit(0 if args.run(args) else 1)
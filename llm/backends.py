@@ -0,0 +1,210 @@
+import os
+import re
+import json
+import time
+import llm.headers as headers
+import llm.prompt as prompt_templates
+
+
+class Completion:
+  """
+  Backend independent result of a generation
+  """
+  def __init__(self, text: str, finish_reason: str = "stop", prompt_tokens: int = 0, cached_tokens: int = None,
+               logprob: float = None):
+    self.text = text
+    self.finish_reason = finish_reason
+    self.prompt_tokens = prompt_tokens
+    self.cached_tokens = cached_tokens   # None if the backend does not report it
+    self.logprob = logprob               # mean log-probability of the generated tokens (if requested)
+
+
+class VLLMBackend:
+  """
+  Local vLLM engine (needs a GPU and the model weights)
+  """
+  def __init__(self, model: str, max_model_len: int, download_dir: str, prefix_caching: bool = True,
+               gpu_memory_utilization: float = 0.75):
+    from vllm import LLM
+    self.llm_engine = LLM(model=model,
+                          dtype="auto",
+                          gpu_memory_utilization=gpu_memory_utilization,
+                          max_model_len=max_model_len,
+                          download_dir=download_dir,
+                          enable_prefix_caching=prefix_caching,
+                          disable_log_stats=True)
+
+  def count_tokens(self, text: str) -> int:
+    return len(self.llm_engine.get_tokenizer().encode(text, add_special_tokens=False))
+
+  def generate(self, prompts: list, params: dict, use_tqdm: bool = False) -> list:
+    from vllm import SamplingParams
+    from vllm.sampling_params import GuidedDecodingParams
+    params = dict(params)
+    if params.get("guided_json"):
+      # compact JSON only: the response ends as soon as the list is closed
+      params["guided_decoding"] = GuidedDecodingParams(json=params.pop("guided_json"), whitespace_pattern=r"[ ]?")
+    params.pop("guided_json", None)
+    sampling_params = SamplingParams(**params)
+    results = self.llm_engine.generate(prompts, sampling_params=sampling_params, use_tqdm=use_tqdm)
+    return [Completion(result.outputs[0].text,
+                       result.outputs[0].finish_reason,
+                       len(result.prompt_token_ids),
+                       getattr(result, "num_cached_tokens", None),
+                       mean_logprob(result.outputs[0]) if params.get("logprobs") is not None else None) for result in results]
+
+
+class OpenAIBackend:
+  """
+  Remote OpenAI-compatible completions server (e.g. vllm serve <model>) shared by several workers.
+  One request per prompt is issued concurrently (at most max_in_flight at a time) on a pooled
+  keep-alive connection, failed requests are retried with exponential backoff and the
+  completions are returned in the order of the prompts
+  """
+  RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+  def __init__(self, api_url: str, model: str, max_in_flight: int = 64, retries: int = 3, timeout: float = 600):
+    import asyncio
+    self.api_url = api_url.rstrip("/")
+    self.model = model
+    self.max_in_flight = max_in_flight
+    self.retries = retries
+    self.timeout = timeout
+    self.loop = asyncio.new_event_loop()   # owns the connection pool for the whole run
+    self.session = None
+
+  def count_tokens(self, text: str) -> int:
+    return len(text) // 4   # rough estimate, the tokenizer is on the server
+
+  def generate(self, prompts: list, params: dict, use_tqdm: bool = False) -> list:
+    return self.loop.run_until_complete(self.generate_async(prompts, params))
+
+  async def generate_async(self, prompts: list, params: dict) -> list:
+    import asyncio
+    import aiohttp
+    if self.session is None:
+      connector = aiohttp.TCPConnector(limit=self.max_in_flight, keepalive_timeout=60)
+      self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+    semaphore = asyncio.Semaphore(self.max_in_flight)
+    return await asyncio.gather(*[self.complete(semaphore, prompt, params) for prompt in prompts])
+
+  async def complete(self, semaphore, prompt: str, params: dict) -> Completion:
+    import asyncio
+    import aiohttp
+    body = dict(params, model=self.model, prompt=prompt)
+    if body.get("guided_json"):
+      body["guided_whitespace_pattern"] = r"[ ]?"
+    else:
+      body.pop("guided_json", None)
+    async with semaphore:
+      for attempt in range(self.retries + 1):
+        try:
+          async with self.session.post(f"{self.api_url}/completions", json=body) as response:
+            if response.status not in self.RETRY_STATUS:
+              response.raise_for_status()
+              payload = await response.json()
+              break
+            error = f"HTTP {response.status}"
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+          error = exc
+        if attempt == self.retries:
+          raise RuntimeError(f"request to {self.api_url} failed after {self.retries} retries: {error}")
+        if os.getenv("DEBUG")=="1": print(f"request failed ({error}), retrying...")
+        await asyncio.sleep(0.5 * 2 ** attempt)
+    choice = payload["choices"][0]
+    usage = payload.get("usage") or {}
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    token_logprobs = [value for value in ((choice.get("logprobs") or {}).get("token_logprobs") or []) if value is not None]
+    logprob = sum(token_logprobs) / len(token_logprobs) if token_logprobs else None
+    return Completion(choice["text"], choice.get("finish_reason") or "stop", usage.get("prompt_tokens", 0), cached, logprob)
+
+  def close(self) -> None:
+    if self.session is not None:
+      self.loop.run_until_complete(self.session.close())
+      self.session = None
+
+
+class StubBackend:
+  """
+  Deterministic rule-based stand-in for the model, to exercise and profile the pipeline without a GPU.
+  Detection returns regex matches (emails, phones, numbers, dates, capitalized names),
+  obfuscation shifts digits and letters. Latency is simulated as
+  latency seconds per call plus the generated tokens at throughput tokens/s (0 = instant)
+  """
+  DETECTION_PATTERN = re.compile(
+    r"[\w.+-]+@[\w-]+\.[\w.]+"                                          # email
+    r"|\(?\+?\d[\d\s().-]{6,}\d"                                        # phone, card and account numbers
+    r"|\b\d{1,2}\s(?:January|February|March|April|May|June|July|August|September|October|November|December)\s\d{4}\b"
+    r"|\b(?:January|February|March|April|May|June|July|August|September|October|November|December)\s\d{1,2},\s\d{4}\b"
+    r"|\b\d{1,4}[/-]\d{1,2}[/-]\d{1,4}\b"                               # numeric dates
+    r"|\b[A-Z][a-z]+(?:\s[A-Z][a-z]+)+\b"                               # capitalized names
+  )
+
+  def __init__(self, latency: float = 0.0, throughput: float = 0.0):
+    self.latency = latency
+    self.throughput = throughput
+
+  def count_tokens(self, text: str) -> int:
+    return len(text) // 4
+
+  def generate(self, prompts: list, params: dict, use_tqdm: bool = False) -> list:
+    completions = []
+    for prompt in prompts:
+      pre_prompt, user_prompt = headers.parse_llama_prompt(prompt)
+      if pre_prompt == prompt_templates.REDACTION_INSTRUCTION_V1:
+        text = shift_characters(user_prompt)
+      else:
+        matches = list(dict.fromkeys(match.group().strip() for match in self.DETECTION_PATTERN.finditer(user_prompt)))
+        if params.get("guided_json"):
+          text = json.dumps([{"text": match, "type": stub_entity_type(match)} for match in matches])
+        else:
+          text = ", ".join(matches) or "None"
+      finish_reason = "stop"
+      if self.count_tokens(text) > params.get("max_tokens", self.count_tokens(text)):
+        text, finish_reason = text[:4 * params["max_tokens"]], "length"
+      completions.append(Completion(text, finish_reason, self.count_tokens(prompt)))
+
+    generated = sum(self.count_tokens(completion.text) + 1 for completion in completions)
+    time.sleep(self.latency + (generated / self.throughput if self.throughput else 0))
+    return completions
+
+
+def mean_logprob(output) -> float:
+  """
+  mean log-probability of the tokens of a vLLM CompletionOutput
+  """
+  if not output.token_ids:
+    return 0.0
+  if output.cumulative_logprob is not None:
+    return output.cumulative_logprob / len(output.token_ids)
+  if output.logprobs:
+    return sum(logprobs[token].logprob for token, logprobs in zip(output.token_ids, output.logprobs)) / len(output.token_ids)
+  return None
+
+
+def stub_entity_type(text: str) -> str:
+  if "@" in text:
+    return "EMAIL"
+  if any(month in text for month in ("January", "February", "March", "April", "May", "June", "July",
+                                     "August", "September", "October", "November", "December")) or re.fullmatch(r"[\d/-]+", text):
+    return "DATE"
+  if any(char.isdigit() for char in text):
+    return "PHONE"
+  return "NAME"
+
+
+def shift_characters(text: str) -> str:
+  """
+  deterministic fake value with the same shape of the input: digits +1, letters +1 (case preserved)
+  """
+  shifted = ""
+  for char in text:
+    if char.isdigit():
+      shifted += str((int(char) + 1) % 10)
+    elif "a" <= char <= "z":
+      shifted += chr((ord(char) - ord("a") + 1) % 26 + ord("a"))
+    elif "A" <= char <= "Z":
+      shifted += chr((ord(char) - ord("A") + 1) % 26 + ord("A"))
+    else:
+      shifted += char
+  return shifted
@@ -0,0 +1,84 @@
+import json
+import sqlite3
+import hashlib
+import time
+from pathlib import Path
+
+
+class ResponseCache:
+  """
+  Persistent content-addressed cache of LLM responses (SQLite).
+
+  The key is the hash of everything that determines a response: model and sampling
+  parameters, instruction, few-shot examples and the prompt itself.
+  When more than max_entries responses are stored the least recently used ones are evicted.
+  """
+  def __init__(self, db_path: Path, max_entries: int = 200000):
+    self.db_path = Path(db_path)
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    self.db_path.parent.mkdir(parents=True, exist_ok=True)
+    self.conn = sqlite3.connect(str(self.db_path))
+    self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, last_used REAL NOT NULL)")
+    self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+    self.conn.commit()
+
+  @staticmethod
+  def make_key(signature: dict, pre_prompt: str, examples: list, prompt: str) -> str:
+    """
+    sha256 of the canonical json of the inputs of the generation
+    """
+    payload = json.dumps([signature, pre_prompt, examples, prompt], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+  def get_many(self, keys: list) -> dict:
+    """
+    Returns {key: response} for the cached keys and refreshes their last use
+    """
+    found = {}
+    unique_keys = list(dict.fromkeys(keys))
+    for start in range(0, len(unique_keys), 500):   # stay below the sqlite variables limit
+      chunk = unique_keys[start:start + 500]
+      rows = self.conn.execute(f"SELECT key, response FROM responses WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+      found.update(rows.fetchall())
+    if found:
+      now = time.time()
+      self.conn.executemany("UPDATE responses SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+      self.conn.commit()
+    self.hits += sum(1 for key in keys if key in found)
+    self.misses += sum(1 for key in keys if key not in found)
+    return found
+
+  def put_many(self, items: dict) -> None:
+    """
+    Stores {key: response} and evicts the least recently used entries above max_entries
+    """
+    now = time.time()
+    self.conn.executemany("INSERT OR REPLACE INTO responses (key, response, last_used) VALUES (?, ?, ?)",
+                          [(key, response, now) for key, response in items.items()])
+    size = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+    if size > self.max_entries:
+      self.conn.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                        (size - self.max_entries,))
+    self.conn.commit()
+
+  def generate(self, signature: dict, pre_prompt: str, examples: list, prompts: list, generate) -> list:
+    """
+    Responses to a list of prompts: only the prompts missing from the cache (deduplicated)
+    are passed to generate (list of prompts -> list of responses) and the results are stored
+    """
+    keys = [self.make_key(signature, pre_prompt, examples, item) for item in prompts]
+    responses = self.get_many(keys)
+    missing = {key: item for key, item in zip(keys, prompts) if key not in responses}
+    if missing:
+      generated = generate(list(missing.values()))
+      new_items = dict(zip(missing.keys(), generated))
+      self.put_many(new_items)
+      responses.update(new_items)
+    return [responses[key] for key in keys]
+
+  def stats(self) -> str:
+    total = self.hits + self.misses
+    rate = 100 * self.hits / total if total else 0
+    return f"response cache: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate)"
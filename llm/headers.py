@@ -12,6 +12,13 @@ def generate_llama_prompt(prompt: str, pre_prompt: str, examples_arr: list) -> s
   This is the last step in prompt processing before feeding the model.
   See https://www.llama.com/docs/model-cards-and-prompt-formats/meta-llama-3/#llama-3-instruct
   """
+  return generate_llama_prefix(pre_prompt, examples_arr) + generate_llama_suffix(prompt)
+
+
+def generate_llama_prefix(pre_prompt: str, examples_arr: list) -> str:
+  """
+  LLAMA-3 static part of the prompt (system prompt and few-shot examples), shared by every prompt of a task
+  """
   examples = ""
   for item in examples_arr:
     user_prompt = item["user"]
@@ -22,6 +29,14 @@ def generate_llama_prompt(prompt: str, pre_prompt: str, examples_arr: list) -> s
     f"{BOT}{S_HEADER}system{E_HEADER}\n\n"
     f"{pre_prompt}{EOT}\n"
     f"{examples}"
+  )
+
+
+def generate_llama_suffix(prompt: str) -> str:
+  """
+  LLAMA-3 variable part of the prompt (user turn)
+  """
+  return (
     f"{S_HEADER}user{E_HEADER}\n\n"
     f"{prompt}{EOT}\n"
     f"{S_HEADER}assistant{E_HEADER}\n\n"
@@ -33,6 +48,13 @@ def generate_mixtral_prompt(prompt: str, pre_prompt: str, examples_arr: list) ->
   Mixtral prompt format
   See https://huggingface.co/mistralai/Ministral-8B-Instruct-2410
   """
+  return generate_mixtral_prefix(pre_prompt, examples_arr) + generate_mixtral_suffix(prompt)
+
+
+def generate_mixtral_prefix(pre_prompt: str, examples_arr: list) -> str:
+  """
+  Mixtral static part of the prompt (system prompt and few-shot examples)
+  """
   examples = ""
   for item in examples_arr:
     user_prompt = item["user"]
@@ -42,5 +64,23 @@ def generate_mixtral_prompt(prompt: str, pre_prompt: str, examples_arr: list) ->
   return (
     f"<s>[INST]{pre_prompt}[/INST]\n"
     f"{examples}"
-    f"[INST]{prompt}[/INST]<s>\n"
-  )
\ No newline at end of file
+  )
+
+
+def generate_mixtral_suffix(prompt: str) -> str:
+  """
+  Mixtral variable part of the prompt (user turn)
+  """
+  return f"[INST]{prompt}[/INST]<s>\n"
+
+
+def parse_llama_prompt(prompt: str) -> tuple:
+  """
+  Inverse of generate_llama_prompt: returns the (pre_prompt, prompt) of a LLAMA-3 formatted prompt
+  """
+  system_header = f"{S_HEADER}system{E_HEADER}\n\n"
+  user_header = f"{S_HEADER}user{E_HEADER}\n\n"
+  start = prompt.find(system_header)
+  pre_prompt = prompt[start + len(system_header):prompt.find(EOT, start)] if start >= 0 else ""
+  start = prompt.rfind(user_header) + len(user_header)
+  return pre_prompt, prompt[start:prompt.find(EOT, start)]
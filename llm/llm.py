@@ -1,43 +1,183 @@
 import os
-from vllm import SamplingParams, LLM
+import json
 import llm.headers as headers
+from llm.backends import VLLMBackend, OpenAIBackend, StubBackend
 
 CACHE_PATH = "/mnt/dmif-nas/SMDC/HF-Cache/"
 
 class LLMChat:
   """
   Wrapper for the LLM model.
+  The inference engine is selected with --backend: vllm (local model), openai (remote server), stub (no model).
+  With --draft-model every prompt is first answered by the small draft model and only the responses
+  meeting an escalation rule are generated again by the large model (two-tier cascade)
   """
   def __init__(self, args):
     #print(f"using {args.model}...")
     self.args = args
-    self.llm_engine = LLM(model=args.model,
-                          dtype="auto",
-                          gpu_memory_utilization=0.75,
-                          max_model_len=args.count,
-                          download_dir=CACHE_PATH,
-                          disable_log_stats=True)
+    self.prefix_caching = not args.no_prefix_cache
+    self.backend = self.create_backend(args.backend, args.model, args.api_url, args.gpu_memory)
+    if args.draft_model:
+      self.draft_backend = self.create_backend(args.draft_backend or args.backend, args.draft_model,
+                                               args.draft_api_url or args.api_url, args.draft_gpu_memory)
+    else:
+      self.draft_backend = None
+    self.prefixes = {}   # (model, pre_prompt, examples) -> [static prefix, number of tokens, prompts submitted]
+    self.prefill_stats = {"prompts": 0, "prompt_tokens": 0, "cached_tokens": 0, "estimated_tokens": 0}
+    self.tier_stats = {"draft": 0, "escalated": 0}
+
+  def create_backend(self, backend: str, model: str, api_url: str, gpu_memory: float):
+    if backend == "vllm":
+      return VLLMBackend(model, self.max_model_len(), CACHE_PATH, self.prefix_caching, gpu_memory)
+    elif backend == "openai":
+      return OpenAIBackend(api_url, model, self.args.max_in_flight, self.args.retries)
+    elif backend == "stub":
+      return StubBackend(self.args.stub_latency, self.args.stub_throughput)
+    else:
+      raise ValueError(f"Invalid backend: {backend}")
 
-  def generate_response(self, pre_prompt: str, examples: list, prompt: str, temperature: float = 0.0) -> str:
+  def sampling_signature(self, temperature: float, max_tokens: int = None, guided_json: dict = None) -> dict:
     """
-    Generate a response from the model given a prompt and examples."""
+    Backend, model and sampling parameters that determine a response (used as part of the cache key)
+    """
+    return {"backend": self.args.backend, "model": self.args.model, "temperature": temperature,
+            "max_tokens": max_tokens or self.args.count, "guided_json": guided_json,
+            "draft_model": self.args.draft_model}
 
-    sampling_params = SamplingParams(temperature=temperature, max_tokens=self.args.count)
+  def max_model_len(self) -> int:
+    return self.args.max_model_len or self.args.count
 
-    # Generate the correct prompt format for the model (only two models supported for now)
-    if self.args.model == "mistralai/Ministral-8B-Instruct-2410":
-      pr = headers.generate_mixtral_prompt(prompt, pre_prompt, examples)
-    else:
-      pr = headers.generate_llama_prompt(prompt, pre_prompt, examples)
-    
-    if os.getenv("DEBUG")=="2":
-      print("\nPrompt:", pr)
-    elif os.getenv("DEBUG")=="1":
-      print("\nPrompt:", prompt)
+  def prompt_budget(self, pre_prompt: str, examples: list, output_reserve: int) -> int:
+    """
+    Tokens available for the user text of a prompt: context window minus
+    the static prefix, the chat headers and the tokens reserved for the response
+    """
+    template = self.backend.count_tokens(self.format_prompt("", pre_prompt, examples))
+    return self.max_model_len() - template - output_reserve
+
+  def get_prefix(self, pre_prompt: str, examples: list, model: str = None) -> list:
+    """
+    Static part of the prompt of a task (system prompt + few-shot examples), built once per task and model
+    """
+    model = model or self.args.model
+    key = (model, pre_prompt, json.dumps(examples, sort_keys=True))
+    if key not in self.prefixes:
+      if model == "mistralai/Ministral-8B-Instruct-2410":
+        prefix = headers.generate_mixtral_prefix(pre_prompt, examples)
+      else:
+        prefix = headers.generate_llama_prefix(pre_prompt, examples)
+      backend = self.backend if model == self.args.model else self.draft_backend
+      self.prefixes[key] = [prefix, backend.count_tokens(prefix), 0]
+    return self.prefixes[key]
+
+  def format_prompt(self, prompt: str, pre_prompt: str, examples: list, model: str = None) -> str:
+    """
+    Generate the correct prompt format for the model (only two models supported for now)
+    """
+    model = model or self.args.model
+    prefix = self.get_prefix(pre_prompt, examples, model)[0]
+    if model == "mistralai/Ministral-8B-Instruct-2410":
+      return prefix + headers.generate_mixtral_suffix(prompt)
+    return prefix + headers.generate_llama_suffix(prompt)
 
-    results = self.llm_engine.generate(pr, sampling_params=sampling_params, use_tqdm=True if os.getenv("DEBUG")=="3" else False)
-    
+  def generate_response(self, pre_prompt: str, examples: list, prompt, temperature: float = 0.0, max_tokens: int = None):
+    """
+    Generate a response from the model given a prompt and examples.
+    prompt can be a single string or a list of strings: a list is submitted to the engine
+    in a single generate call (continuous batching) and a list of responses is returned in the same order.
+    """
+    results = self.generate_completions(pre_prompt, examples, prompt, temperature, max_tokens)
     if isinstance(prompt, str):
-      return results[0].outputs[0].text
+      return results[0].text
     else:
-      return [result.outputs[0].text for result in results]
+      return [result.text for result in results]
+
+  def generate_completions(self, pre_prompt: str, examples: list, prompt, temperature: float = 0.0, max_tokens: int = None,
+                           guided_json: dict = None, escalate=None) -> list:
+    """
+    Same as generate_response but returns the backend Completion objects (text, finish_reason, token counts).
+    guided_json: JSON schema the responses must follow (guided decoding)
+    escalate: optional caller rule (index of the prompt, draft Completion) -> bool, in addition to
+    truncation and low log-probability, to send a prompt to the large model
+    """
+    params = {"temperature": temperature, "max_tokens": max_tokens or self.args.count}
+    if guided_json:
+      params["guided_json"] = guided_json
+
+    prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+
+    if os.getenv("DEBUG")=="1":
+      print("\nPrompt:", prompt)
+
+    if self.draft_backend is None:
+      return self.run(self.backend, self.args.model, prompts, pre_prompt, examples, params)
+
+    results = self.run(self.draft_backend, self.args.draft_model, prompts, pre_prompt, examples, dict(params, logprobs=0))
+    escalated = [idx for idx, result in enumerate(results)
+                 if self.needs_escalation(result) or (escalate is not None and escalate(idx, result))]
+    if escalated:
+      large_results = self.run(self.backend, self.args.model, [prompts[idx] for idx in escalated], pre_prompt, examples, params)
+      for idx, result in zip(escalated, large_results):
+        results[idx] = result
+    self.tier_stats["draft"] += len(results)
+    self.tier_stats["escalated"] += len(escalated)
+    return results
+
+  def run(self, backend, model: str, prompts: list, pre_prompt: str, examples: list, params: dict) -> list:
+    """
+    Formats the prompts for the model and generates them with the backend in a single call
+    """
+    pr = [self.format_prompt(item, pre_prompt, examples, model) for item in prompts]
+    if os.getenv("DEBUG")=="2":
+      print("\nPrompt:", "\n".join(pr))
+
+    use_tqdm = len(pr) > 1 or os.getenv("DEBUG")=="3"
+    results = backend.generate(pr, params, use_tqdm=use_tqdm)
+    self.update_prefill_stats(backend, self.get_prefix(pre_prompt, examples, model), results)
+    return results
+
+  def needs_escalation(self, completion) -> bool:
+    """
+    built-in escalation rules of the cascade: truncated response or low mean log-probability
+    """
+    if completion.finish_reason == "length":
+      return True
+    return completion.logprob is not None and completion.logprob < self.args.escalation_logprob
+
+  def update_prefill_stats(self, backend, prefix: list, results: list) -> None:
+    """
+    Counts the prompt tokens served from the prefix cache, as reported by the engine.
+    When a local vLLM engine does not report it, every prompt after the first one of a task is estimated
+    to reuse the prefix; other backends without a count (stub, servers that may not cache) are not counted
+    """
+    for result in results:
+      self.prefill_stats["prompts"] += 1
+      self.prefill_stats["prompt_tokens"] += result.prompt_tokens
+      if result.cached_tokens is not None:
+        self.prefill_stats["cached_tokens"] += result.cached_tokens
+      elif isinstance(backend, VLLMBackend) and self.prefix_caching and prefix[2] > 0:
+        self.prefill_stats["estimated_tokens"] += prefix[1]
+      prefix[2] += 1
+
+  def close(self) -> None:
+    """
+    Releases the backend resources (e.g. the connection pool of the openai backend)
+    """
+    for backend in (self.backend, self.draft_backend):
+      if hasattr(backend, "close"):
+        backend.close()
+
+  def report(self) -> str:
+    stats = self.prefill_stats
+    rate = 100 * stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0
+    report = (f"prefill: {stats['prompts']} prompts, {stats['prompt_tokens']} prompt tokens, "
+              f"{stats['cached_tokens']} served from the prefix cache ({rate:.1f}%)")
+    if stats["estimated_tokens"]:
+      rate = 100 * stats["estimated_tokens"] / stats["prompt_tokens"]
+      report += f", about {stats['estimated_tokens']} more estimated from the shared prefix ({rate:.1f}%, not reported by the engine)"
+    if self.draft_backend is not None:
+      tiers = self.tier_stats
+      rate = 100 * tiers["escalated"] / tiers["draft"] if tiers["draft"] else 0
+      report += (f"\ncascade: {tiers['draft']} prompts on {self.args.draft_model}, "
+                 f"{tiers['escalated']} escalated to {self.args.model} ({rate:.1f}%)")
+    return report
@@ -46,3 +46,51 @@ EXAMPLES_ARR_REDACTION = [
   {"user": "superSecret123!", "assistant": "unknown1468!"},
 ]
 
+
+
+# Prompt template for the detection with structured output (OUTPUT_FORMAT = json)
+DETECTION_INSTRUCTION_JSON = (
+"""Your task is to identify only the sensible information in the text.
+
+Nothing else should be identified. If you are not sure do not include it.
+The assistant response must only be a JSON list of the identified values with their type, [] if there are none."""
+)
+
+ENTITY_TYPES = ["NAME", "EMAIL", "PHONE", "ADDRESS", "DATE", "TIME", "ID_NUMBER", "FINANCIAL", "CREDENTIAL", "OTHER"]
+
+# JSON schema of the detection response (guided decoding)
+DETECTION_SCHEMA = {
+  "type": "array",
+  "items": {
+    "type": "object",
+    "properties": {
+      "text": {"type": "string"},
+      "type": {"type": "string", "enum": ENTITY_TYPES},
+    },
+    "required": ["text", "type"],
+  },
+}
+
+# Same examples of EXAMPLES_ARR with the JSON response
+EXAMPLES_ARR_JSON = [
+    {"user": "My name is John Doe, and my email is john.doe@example.com.", 
+     "assistant": '[{"text": "John Doe", "type": "NAME"}, {"text": "john.doe@example.com", "type": "EMAIL"}]'},
+    {"user": "The credit card number is 1234-5678-9101-1121 and the CVV is 321.", 
+     "assistant": '[{"text": "1234-5678-9101-1121", "type": "FINANCIAL"}, {"text": "321", "type": "FINANCIAL"}]'},
+    {"user": "My phone number is (555) 123-4567.", 
+     "assistant": '[{"text": "(555) 123-4567", "type": "PHONE"}]'},
+    {"user": "This document was created on January 1, 2023.", 
+     "assistant": '[{"text": "January 1, 2023", "type": "DATE"}]'},
+    {"user": "The bank account number is 0987654321.", 
+     "assistant": '[{"text": "0987654321", "type": "FINANCIAL"}]'},
+    {"user": "Hello, how are you today?", 
+     "assistant": '[]'},
+    {"user": "My social security number is 123-45-6789.", 
+     "assistant": '[{"text": "123-45-6789", "type": "ID_NUMBER"}]'},
+    {"user": "Please meet me at 1234 Elm Street, Springfield at 3 PM.", 
+     "assistant": '[{"text": "1234 Elm Street, Springfield", "type": "ADDRESS"}, {"text": "3 PM", "type": "TIME"}]'},
+    {"user": "I will call you tomorrow.", 
+     "assistant": '[]'},
+    {"user": "The meeting password is superSecret123!", 
+     "assistant": '[{"text": "superSecret123!", "type": "CREDENTIAL"}]'}
+]
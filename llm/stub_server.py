@@ -0,0 +1,56 @@
+"""
+Local stand-in for an OpenAI-compatible inference server, answering /v1/completions with the stub backend.
+Used to exercise the openai backend without a GPU:
+  python -m llm.stub_server --port 8000
+  python main.py --backend openai --api-url http://localhost:8000/v1
+"""
+import json
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from llm.backends import StubBackend
+
+
+class CompletionsHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"   # keep-alive
+  backend = StubBackend()
+
+  def do_POST(self):
+    if self.path.rstrip("/") != "/v1/completions":
+      self.send_error(404)
+      return
+    body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+    prompts = [body["prompt"]] if isinstance(body["prompt"], str) else body["prompt"]
+    completions = self.backend.generate(prompts, body)
+    payload = json.dumps({
+      "object": "text_completion",
+      "model": body.get("model"),
+      "choices": [{"index": idx, "text": completion.text, "finish_reason": completion.finish_reason}
+                  for idx, completion in enumerate(completions)],
+      "usage": {"prompt_tokens": sum(completion.prompt_tokens for completion in completions)},
+    }).encode()
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(payload)))
+    self.end_headers()
+    self.wfile.write(payload)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class StubServer(ThreadingHTTPServer):
+  request_queue_size = 256   # accept many concurrent clients
+  daemon_threads = True
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Stub OpenAI-compatible completions server")
+  parser.add_argument("--host", type=str, default="localhost")
+  parser.add_argument("--port", type=int, default=8000)
+  parser.add_argument("--latency", type=float, default=0.0, help="Simulated seconds per request")
+  parser.add_argument("--throughput", type=float, default=0.0, help="Simulated generated tokens per second, 0 = instant")
+  args = parser.parse_args()
+
+  CompletionsHandler.backend = StubBackend(args.latency, args.throughput)
+  print(f"stub server listening on http://{args.host}:{args.port}/v1")
+  StubServer((args.host, args.port), CompletionsHandler).serve_forever()
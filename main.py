@@ -1,8 +1,11 @@
 import argparse
 import os
 from pathlib import Path
-from PDFProcessor.PDFProcessor import PDFProcessor
-from llm.llm import LLMChat
+from PDFProcessor.PDFProcessor import PDFProcessor, process_pool, redact_pool, detection_prompt
+from llm.cache import ResponseCache
+from PDFProcessor.ObfuscationDictionary import ObfuscationDictionary
+from PDFProcessor.ChunkGate import ChunkGate
+from PDFProcessor.ChunkDedup import ChunkDedup
 import time
 import logging
 import configparser
@@ -18,11 +21,32 @@ def load_conf():
   config.read_file(open('anonymizer.conf'))
   params = dict()
 
+  params.update({"EXTRACTION_ENGINE": config.get('dry_run_mode', 'EXTRACTION_ENGINE')})
+  params.update({"EXTRACT_PAGE_WORKERS": int(config.get('dry_run_mode', 'EXTRACT_PAGE_WORKERS'))})
+  params.update({"TEXT_CACHE": config.getboolean('dry_run_mode', 'TEXT_CACHE')})
   params.update({"MAX_BATCH_SIZE": int(config.get('dry_run_mode', 'MAX_BATCH_SIZE'))})
   params.update({"WORDS_PATH": Path(config.get('general_parameters', 'WORDS_PATH'))})
+  params.update({"RESPONSE_CACHE_SIZE": int(config.get('general_parameters', 'RESPONSE_CACHE_SIZE'))})
+  params.update({"CORPUS_DICTIONARY": config.getboolean('general_parameters', 'CORPUS_DICTIONARY')})
+  params.update({"MATCH_IGNORE_CASE": config.getboolean('general_parameters', 'MATCH_IGNORE_CASE')})
+  params.update({"MATCH_IGNORE_WHITESPACE": config.getboolean('general_parameters', 'MATCH_IGNORE_WHITESPACE')})
+  params.update({"PAGE_WORKERS": int(config.get('general_parameters', 'PAGE_WORKERS'))})
   params.update({"TARGET_WORDS": config.get('redaction_mode', 'TARGET_WORDS')})
   params.update({"NOT_ALLOWED_CHARS": config.get('dry_run_mode', 'NOT_ALLOWED_CHARS')})
   params.update({"MIN_LENGTH": int(config.get('dry_run_mode', 'MIN_LENGTH'))})
+  params.update({"BATCH_MODE": config.get('dry_run_mode', 'BATCH_MODE')})
+  params.update({"OUTPUT_RESERVE": int(config.get('dry_run_mode', 'OUTPUT_RESERVE'))})
+  params.update({"PRE_DETECTION": config.getboolean('dry_run_mode', 'PRE_DETECTION')})
+  params.update({"MASK_PRE_DETECTED": config.getboolean('dry_run_mode', 'MASK_PRE_DETECTED')})
+  params.update({"GATE_THRESHOLD": int(config.get('dry_run_mode', 'GATE_THRESHOLD'))})
+  params.update({"DEDUP": config.getboolean('dry_run_mode', 'DEDUP')})
+  params.update({"DEDUP_SIMILARITY": float(config.get('dry_run_mode', 'DEDUP_SIMILARITY'))})
+  params.update({"OUTPUT_FORMAT": config.get('dry_run_mode', 'OUTPUT_FORMAT')})
+  params.update({"EXCLUDED_TYPES": [item.strip() for item in config.get('dry_run_mode', 'EXCLUDED_TYPES').split(",") if item.strip()]})
+  params.update({"MAX_POOL_SEQUENCES": int(config.get('dry_run_mode', 'MAX_POOL_SEQUENCES'))})
+  params.update({"EXTRACT_WORKERS": int(config.get('dry_run_mode', 'EXTRACT_WORKERS'))})
+  params.update({"WRITE_WORKERS": int(config.get('dry_run_mode', 'WRITE_WORKERS'))})
+  params.update({"PIPELINE_QUEUE_SIZE": int(config.get('dry_run_mode', 'PIPELINE_QUEUE_SIZE'))})
   params.update({"HIGHLIGHT_COLOR": literal_eval(config.get('dry_run_mode', 'HIGHLIGHT_COLOR'))})
   params.update({"OPACITY": float(config.get('dry_run_mode', 'OPACITY'))})
   params.update({"REDACTION": config.get('redaction_mode', 'REDACTION')})
@@ -30,21 +54,88 @@ def load_conf():
   params.update({"TEXT_COLOR": literal_eval(config.get('redaction_mode', 'TEXT_COLOR'))})
   params.update({"FONT_SIZE": int(config.get('redaction_mode', 'FONT_SIZE'))})
   params.update({"METADATA": config.get('redaction_mode', 'METADATA')})
+  params.update({"REPLAY_GEOMETRY": config.getboolean('redaction_mode', 'REPLAY_GEOMETRY')})
 
   return params
 
-if __name__ == "__main__":
-
+def build_parser():
   parser = argparse.ArgumentParser(description="Run LLama Anonimyzer", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument("--mode", type=str, default="dry-run", help="dry-run: only model inference, redact: redact the PDFs")
   parser.add_argument("--count", type=int, default=1500, help="Max number of tokens to generate")
+  parser.add_argument("--max-model-len", type=int, default=None, help="Context window of the model (default: --count)")
   parser.add_argument("--temperature", type=float, default=0.7, help="Temperature in the softmax")
   parser.add_argument("--gen", default="3", help=f"""Generation of the model to use""")  # NOT USED
   parser.add_argument("--size", type=str, default="3B", help=f"""Size of model to use""")  # NOT USED
   parser.add_argument("--model", type=str, default="meta-llama/Llama-3.1-8B-Instruct", help="Hugging Face model to use")
+  parser.add_argument("--backend", type=str, default="vllm", choices=["vllm", "openai", "stub"], help="Inference engine: local vLLM, remote OpenAI-compatible server or rule-based stub (no GPU, for benchmarks)")
+  parser.add_argument("--api-url", type=str, default="http://localhost:8000/v1", help="Base URL of the OpenAI-compatible server (openai backend)")
+  parser.add_argument("--max-in-flight", type=int, default=64, help="Max concurrent requests to the server (openai backend)")
+  parser.add_argument("--retries", type=int, default=3, help="Retries with exponential backoff of a failed request (openai backend)")
+  parser.add_argument("--stub-latency", type=float, default=0.0, help="Simulated seconds per generate call (stub backend)")
+  parser.add_argument("--stub-throughput", type=float, default=0.0, help="Simulated generated tokens per second, 0 = instant (stub backend)")
+  parser.add_argument("--gpu-memory", type=float, default=0.75, help="Fraction of GPU memory for the model (vllm backend)")
+  parser.add_argument("--draft-model", type=str, default=None, help="Small model answering every prompt first, uncertain responses are escalated to --model")
+  parser.add_argument("--draft-backend", type=str, default=None, choices=["vllm", "openai", "stub"], help="Inference engine of the draft model (default: --backend)")
+  parser.add_argument("--draft-api-url", type=str, default=None, help="Base URL of the server of the draft model (default: --api-url)")
+  parser.add_argument("--draft-gpu-memory", type=float, default=0.2, help="Fraction of GPU memory for the draft model (vllm backend)")
+  parser.add_argument("--escalation-logprob", type=float, default=-0.5, help="Draft responses with a lower mean token log-probability are escalated")
+  parser.add_argument("--no-prefix-cache", action="store_true", help="Disable the automatic prefix caching of the few-shot prompt")
+  parser.add_argument("--workers", type=int, default=1, help="Processes redacting the PDFs of a folder in parallel (redaction mode)")
+  parser.add_argument("--pipeline", action="store_true", help="dry-run of a folder overlapping extraction, inference and writing in separate stages")
   parser.add_argument("--pdfsrc", type=Path, default=Path("pdf_in"), help="Source path for PDFs")
   parser.add_argument("--pdfdst", type=Path, default=Path("pdf_out"), help="Destination path for PDFs")
   parser.add_argument("--mddst", type=Path, default=Path("md_out"), help="Destination path for MDs")
+  return parser
+
+def load_resources(args, params, mode):
+  """Model, response cache, dictionary, gate and dedup index shared by all the PDFs of a run."""
+  # istantiate LLM model only if dry-run mode is selected
+  if mode == "dry-run":
+    from llm.llm import LLMChat
+    llm = LLMChat(args)
+  else:
+    llm = None
+
+  # token budget of the detection batches
+  if llm is not None:
+    params["TOKENIZER"] = args.model if args.backend == "vllm" else None
+    if params["BATCH_MODE"] == "tokens":
+      instruction, examples, _ = detection_prompt(params)
+      params["TOKEN_BUDGET"] = llm.prompt_budget(instruction, examples, params["OUTPUT_RESERVE"])
+      params["DETECTION_MAX_TOKENS"] = params["OUTPUT_RESERVE"]
+      if params["TOKEN_BUDGET"] <= 0:
+        raise ValueError(f"--max-model-len {llm.max_model_len()} leaves no room for the text after the few-shot prompt and OUTPUT_RESERVE")
+      print(f"batches of at most {params['TOKEN_BUDGET']} tokens")
+    else:
+      params["DETECTION_MAX_TOKENS"] = args.count
+
+  # persistent cache of the detection responses
+  if mode == "dry-run" and params["RESPONSE_CACHE_SIZE"] > 0:
+    cache = ResponseCache(params["WORDS_PATH"] / "responses.sqlite", params["RESPONSE_CACHE_SIZE"])
+  else:
+    cache = None
+
+  # corpus-wide word -> replacement dictionary shared by all the PDFs
+  if params["CORPUS_DICTIONARY"]:
+    dictionary = ObfuscationDictionary(params["WORDS_PATH"] / "dictionary.tsv")
+    print(f"loaded {len(dictionary.entries)} words from the corpus dictionary")
+  else:
+    dictionary = None
+
+  # gate skipping the batches without candidates of sensitive data
+  if mode == "dry-run" and params["GATE_THRESHOLD"] > 0:
+    gate = ChunkGate(params["GATE_THRESHOLD"], dictionary.entries if dictionary is not None else ())
+  else:
+    gate = None
+
+  # run-wide index of the batches already inferred
+  dedup = ChunkDedup(params["DEDUP_SIMILARITY"]) if mode == "dry-run" and params["DEDUP"] else None
+
+  return llm, cache, dictionary, gate, dedup
+
+if __name__ == "__main__":
+
+  parser = build_parser()
   args = parser.parse_args()
 
   # Check if the source folder exists
@@ -56,26 +147,49 @@ if __name__ == "__main__":
 
   start_time = time.perf_counter()   # Start timer
 
-  # istantiate LLM model only if dry-run mode is selected
-  if args.mode == "dry-run":
-    llm = LLMChat(args)
-  else:
-    llm = None
+  llm, cache, dictionary, gate, dedup = load_resources(args, params, args.mode)
 
-  if args.pdfsrc.is_dir():
+  if args.pdfsrc.is_dir() and args.mode == "dry-run" and args.pipeline:
+    from PDFProcessor.DryRunPipeline import DryRunPipeline
+    jobs = [(args.pdfsrc / pdf, args.pdfdst / pdf) for pdf in os.listdir(args.pdfsrc) if pdf.endswith(".pdf")]
+    pipeline = DryRunPipeline(params, llm, args.temperature, cache, dictionary, gate, dedup)
+    pipeline.run(jobs)
+    print(pipeline.report())
+  elif args.pdfsrc.is_dir() and args.mode == "redaction" and args.workers > 1:
+    jobs = [(args.pdfsrc / pdf, args.pdfdst / pdf) for pdf in os.listdir(args.pdfsrc) if pdf.endswith(".pdf")]
+    print(redact_pool(params, jobs, args.workers))
+  elif args.pdfsrc.is_dir():
+    pdfs = []
     for pdf in os.listdir(args.pdfsrc):
       if pdf.endswith(".pdf"):
-        doc = PDFProcessor(params, args.pdfsrc / pdf, args.pdfdst / pdf)
-        doc.process_pdf(llm, args.temperature, args.mode)
+        pdfs.append(pdf)
       else:
         print(f"skipping {pdf}")
+    docs = (PDFProcessor(params, args.pdfsrc / pdf, args.pdfdst / pdf, cache, dictionary, gate, dedup) for pdf in pdfs)
+    if args.mode == "dry-run":
+      # the batches of several PDFs are pooled in the same generate calls,
+      # each PDF is extracted only when the calls have room for its batches
+      process_pool(llm, docs, args.temperature)
+    else:
+      for doc in docs:
+        doc.process_pdf(llm, args.temperature, args.mode)
   else:
     # expeted full file path in psdsrc
     pdf = os.path.basename(args.pdfsrc)
     if pdf.endswith(".pdf"):
-      doc = PDFProcessor(params, args.pdfsrc, args.pdfdst)
+      doc = PDFProcessor(params, args.pdfsrc, args.pdfdst, cache, dictionary, gate, dedup)
       doc.process_pdf(llm, args.temperature, args.mode)
 
+  if cache is not None:
+    print(cache.stats())
+  if gate is not None:
+    print(gate.stats())
+  if dedup is not None:
+    print(dedup.stats())
+  if llm is not None:
+    print(llm.report())
+    llm.close()
+
   end_time = time.perf_counter()
   elapsed_time = end_time - start_time
 
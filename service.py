@@ -0,0 +1,363 @@
+import base64
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import fitz
+
+from main import build_parser, load_conf, load_resources
+from PDFProcessor.PDFProcessor import PDFProcessor, detect_pool
+
+MODES = ("dry-run", "redaction")
+
+
+class Job:
+  """
+  A PDF submitted to the service and its state: queued, running, done or failed
+  """
+  def __init__(self, mode: str, pdf_path: Path, output_path: Path, priority: int = 0):
+    self.id = uuid.uuid4().hex[:12]
+    self.mode = mode
+    self.pdf_path = pdf_path
+    self.output_path = output_path
+    self.priority = priority
+    self.pages = None   # counted by the worker thread when the job enters the queue order
+    self.state = "queued"
+    self.error = None
+    self.words = None
+    self.submitted = time.time()
+    self.started = None
+    self.finished = None
+
+  def count_pages(self) -> None:
+    try:
+      with fitz.open(self.pdf_path) as pdf:
+        self.pages = pdf.page_count
+    except Exception:
+      self.pages = None
+
+  def status(self) -> dict:
+    now = time.time()
+    return {"id": self.id, "mode": self.mode, "name": self.pdf_path.name, "state": self.state,
+            "priority": self.priority, "pages": self.pages, "words": self.words, "error": self.error,
+            "queued_s": round((self.started or now) - self.submitted, 3),
+            "run_s": round((self.finished or now) - self.started, 3) if self.started else None}
+
+
+class JobQueue:
+  """
+  Jobs waiting for the worker ordered by priority (lower first), then by number of pages
+  when shortest_first is set, then by arrival.
+  PyMuPDF is not thread-safe: the jobs put by the HTTP threads wait in arrivals until the worker thread
+  counts their pages (in get and get_nowait) and moves them to the heap
+  """
+  def __init__(self, shortest_first: bool = False):
+    self.shortest_first = shortest_first
+    self.heap = []
+    self.arrivals = []
+    self.counter = itertools.count()
+    self.cond = threading.Condition()
+    self.closed = False
+
+  def put(self, job: Job) -> None:
+    with self.cond:
+      self.arrivals.append(job)
+      self.cond.notify()
+
+  def admit(self) -> None:
+    """
+    Counts the pages of the jobs arrived and moves them to the heap (worker thread only)
+    """
+    with self.cond:
+      arrivals, self.arrivals = self.arrivals, []
+    for job in arrivals:
+      job.count_pages()
+    with self.cond:
+      for job in arrivals:
+        size = (job.pages if job.pages is not None else float("inf")) if self.shortest_first else 0
+        heapq.heappush(self.heap, (job.priority, size, next(self.counter), job))
+
+  def get(self) -> Job:
+    """
+    Blocks until a job is queued, None once the queue is closed
+    """
+    while True:
+      with self.cond:
+        while not self.heap and not self.arrivals and not self.closed:
+          self.cond.wait()
+        if not self.arrivals:
+          return heapq.heappop(self.heap)[-1] if self.heap else None
+      self.admit()
+
+  def get_nowait(self, mode: str) -> Job:
+    """
+    Next job if it has the given mode (the order is never skipped), else None
+    """
+    self.admit()
+    with self.cond:
+      if self.heap and self.heap[0][-1].mode == mode:
+        return heapq.heappop(self.heap)[-1]
+      return None
+
+  def close(self) -> None:
+    with self.cond:
+      self.closed = True
+      self.cond.notify_all()
+
+  def __len__(self) -> int:
+    return len(self.heap) + len(self.arrivals)
+
+
+class AnonymizerService:
+  """
+  Resident anonymizer: the model is loaded once and the queued jobs are processed by a single worker,
+  the dry-run jobs waiting together are pooled in the same generate calls.
+  """
+  def __init__(self, args, params: dict):
+    self.args = args
+    self.params = params
+    self.spool = args.spool
+    self.jobs = {}
+    self.lock = threading.Lock()
+    self.queue = JobQueue(args.shortest_first)
+    self.ready = threading.Event()
+    self.load_error = None
+    self.worker = threading.Thread(target=self.work, name="anonymizer-worker", daemon=True)
+
+  def start(self) -> None:
+    self.worker.start()
+    self.ready.wait()
+    if self.load_error is not None:
+      raise self.load_error
+
+  def stop(self) -> None:
+    self.queue.close()
+    self.worker.join()
+
+  def submit(self, request: dict) -> Job:
+    """
+    Queues a job from {"mode", "path", "output"} or {"mode", "name", "pdf": base64 bytes}, optional "priority"
+    """
+    mode = request.get("mode", "dry-run")
+    if mode not in MODES:
+      raise ValueError(f"invalid mode {mode}, please choose between {' and '.join(MODES)}")
+    priority = int(request.get("priority", 0))
+    # the request is validated before anything is written
+    if "pdf" in request:
+      name = os.path.basename(str(request.get("name", "upload.pdf")))
+      if Path(name).suffix != ".pdf":
+        raise ValueError(f"{name} is not a PDF")
+      data = base64.b64decode(request["pdf"])
+      folder = self.spool / uuid.uuid4().hex[:12]
+      os.makedirs(folder / "out")
+      pdf_path = folder / name
+      pdf_path.write_bytes(data)
+      output_path = folder / "out" / name
+    elif "path" in request:
+      pdf_path = Path(request["path"])
+      if pdf_path.suffix != ".pdf":
+        raise ValueError(f"{pdf_path.name} is not a PDF")
+      if not pdf_path.is_file():
+        raise ValueError(f"{pdf_path} does not exist")
+      output_path = Path(request["output"]) if "output" in request else self.args.pdfdst / pdf_path.name
+      os.makedirs(output_path.parent, exist_ok=True)
+    else:
+      raise ValueError("either path or pdf is required")
+
+    job = Job(mode, pdf_path, output_path, priority)
+    with self.lock:
+      self.jobs[job.id] = job
+    self.queue.put(job)
+    print(f"queued {job.mode} job {job.id} ({pdf_path.name})")
+    return job
+
+  def job(self, job_id: str) -> Job:
+    with self.lock:
+      return self.jobs.get(job_id)
+
+  def health(self) -> dict:
+    with self.lock:
+      states = [job.state for job in self.jobs.values()]
+    return {"ready": self.ready.is_set(), "queued": len(self.queue), "running": states.count("running"),
+            "done": states.count("done"), "failed": states.count("failed")}
+
+  def work(self) -> None:
+    # loaded in the worker thread: the sqlite connection of the cache can't be shared across threads
+    try:
+      llm, self.cache, self.dictionary, self.gate, self.dedup = load_resources(self.args, self.params, "dry-run")
+    except Exception as e:
+      self.load_error = e
+      self.ready.set()
+      return
+    self.ready.set()
+    while True:
+      job = self.queue.get()
+      if job is None:
+        break
+      if job.mode == "dry-run":
+        self.run_dry_run(llm, job)
+      else:
+        self.run_redaction(job)
+
+    for index in (self.cache, self.gate, self.dedup):
+      if index is not None:
+        print(index.stats())
+    print(llm.report())
+    llm.close()
+
+  def document(self, job: Job) -> PDFProcessor:
+    """
+    The words of a job are cached by content: uploads with the same name never share them,
+    a redaction job finds the words of the dry-run of the same PDF
+    """
+    job.state, job.started = "running", time.time()
+    doc = PDFProcessor(self.params, job.pdf_path, job.output_path, self.cache, self.dictionary, self.gate, self.dedup)
+    doc.words_name = f"{job.pdf_path.stem}-{doc.file_hash()}"
+    return doc
+
+  def finish(self, job: Job, error: Exception = None) -> None:
+    job.finished = time.time()
+    if error is None:
+      job.state = "done"
+    else:
+      job.state, job.error = "failed", f"{type(error).__name__}: {error}"
+    print(f"{job.mode} job {job.id} {job.state} in {job.finished - job.started:.2f}s")
+
+  def run_dry_run(self, llm, job: Job) -> None:
+    """
+    Pools the job with the dry-run jobs next in the queue: the next job is taken from the queue
+    (and extracted) only while the generate calls have room for its batches (MAX_POOL_SEQUENCES)
+    """
+    running = {}   # id(doc) -> job of the documents not finished yet
+
+    def documents(job: Job):
+      while job is not None:
+        try:
+          doc = self.document(job)
+        except Exception as e:
+          self.finish(job, e)
+        else:
+          running[id(doc)] = job
+          yield doc
+        job = self.queue.get_nowait("dry-run")
+
+    def done(docs: list) -> None:
+      for doc in docs:
+        job = running.pop(id(doc))
+        try:
+          doc.save_and_highlight()
+          job.words = len(doc.words)
+          self.finish(job)
+        except Exception as e:
+          self.finish(job, e)
+
+    def failed(doc: PDFProcessor, error: Exception) -> None:
+      self.finish(running.pop(id(doc)), error)
+
+    try:
+      detect_pool(llm, documents(job), self.args.temperature, done, failed)
+    except Exception as e:
+      for job in running.values():
+        self.finish(job, e)
+
+  def run_redaction(self, job: Job) -> None:
+    try:
+      doc = self.document(job)
+      doc.redact()
+      job.words = len(doc.words)
+      self.finish(job)
+    except FileNotFoundError:
+      self.finish(job, FileNotFoundError(f"{job.pdf_path.name} not found in cache, submit a dry-run job first"))
+    except Exception as e:
+      self.finish(job, e)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+  """
+  POST /jobs          queue a job, returns its status
+  GET  /jobs          status of all the jobs
+  GET  /jobs/<id>     status of a job
+  GET  /jobs/<id>/pdf output PDF of a finished job
+  GET  /health        readiness and queue length
+  """
+  service = None
+
+  def send_json(self, payload, code: int = 200) -> None:
+    body = json.dumps(payload).encode()
+    self.send_response(code)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_POST(self):
+    if self.path.rstrip("/") != "/jobs":
+      return self.send_json({"error": "not found"}, 404)
+    try:
+      request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+      if not isinstance(request, dict):
+        raise ValueError("the request must be a json object")
+      job = self.service.submit(request)
+    except (ValueError, TypeError, KeyError) as e:
+      return self.send_json({"error": str(e)}, 400)
+    self.send_json(job.status(), 202)
+
+  def do_GET(self):
+    parts = [part for part in self.path.split("/") if part]
+    if parts == ["health"]:
+      return self.send_json(self.service.health())
+    if parts == ["jobs"]:
+      with self.service.lock:
+        jobs = list(self.service.jobs.values())
+      return self.send_json([job.status() for job in jobs])
+    job = self.service.job(parts[1]) if len(parts) in (2, 3) and parts[0] == "jobs" else None
+    if job is None:
+      return self.send_json({"error": "not found"}, 404)
+    if len(parts) == 2:
+      return self.send_json(job.status())
+    if parts[2] != "pdf" or job.state != "done":
+      return self.send_json({"error": f"no output, job is {job.state}"}, 404)
+    body = job.output_path.read_bytes()
+    self.send_response(200)
+    self.send_header("Content-Type", "application/pdf")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    if os.getenv("DEBUG") == "1":
+      super().log_message(format, *args)
+
+
+if __name__ == "__main__":
+
+  parser = build_parser()
+  parser.description = "Run AnonyMate as a resident service"
+  parser.add_argument("--host", type=str, default="127.0.0.1", help="Address of the HTTP API")
+  parser.add_argument("--port", type=int, default=8080, help="Port of the HTTP API")
+  parser.add_argument("--spool", type=Path, default=Path("service_spool"), help="Folder of the uploaded PDFs and their outputs")
+  parser.add_argument("--shortest-first", action="store_true", help="Among jobs of the same priority run the PDFs with fewer pages first")
+  args = parser.parse_args()
+
+  os.makedirs(args.spool, exist_ok=True)
+  params = load_conf()
+
+  service = AnonymizerService(args, params)
+  print("loading the model...")
+  service.start()
+
+  ServiceHandler.service = service
+  server = ThreadingHTTPServer((args.host, args.port), ServiceHandler)
+  print(f"listening on http://{args.host}:{args.port}")
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.server_close()
+  service.stop()